@@ -12,17 +12,273 @@ Functions:
 
 import re
 import os
+import sys
+import stat
+import errno
+import logging
 import datetime
 import math
+import functools
+import contextlib
+import collections
+import bisect
+import concurrent.futures
+import time
+import select
+import struct
 
 # pylama: ignore=E127,D407,D406
 
-try:
-    from unidecode import unidecode
-except ImportError:
-    def unidecode(x):
-        """Declare dummy function in case unidecode package is not present."""
-        return x
+
+def _import_unidecode():
+    """Return the unidecode function, importing it on first use.
+
+    Importing the unidecode package is slow and most names are plain ASCII,
+    so it is only imported when a non ASCII character is found.
+
+    """
+    try:
+        from unidecode import unidecode as transliterate
+    except ImportError:
+        def transliterate(x):
+            """Declare dummy function in case unidecode is not present."""
+            return x
+    return transliterate
+
+
+class _TransliterationTable(dict):
+    """Memoize the transliteration of each character."""
+
+    __slots__ = ('_transliterate', )
+
+    def __missing__(self, char):
+        if not hasattr(self, '_transliterate'):
+            self._transliterate = _import_unidecode()
+        transliteration = self[char] = self._transliterate(char)
+        return transliteration
+
+
+_transliteration_table = _TransliterationTable()
+
+
+def unidecode(text):
+    """Transliterate Unicode text into plain 7-bit ASCII.
+
+    ASCII text is returned as is. Otherwise every character is
+    transliterated on its own, as unidecode does, through a table of the
+    characters already seen. The text is returned as is if the unidecode
+    package is not present.
+
+    Arguments:
+        text (str): text to be transliterated.
+
+    Returns:
+        str: the transliterated text.
+
+    """
+    if text.isascii():
+        return text
+    return ''.join(map(_transliteration_table.__getitem__, text))
+
+
+class RunStats(object):
+    """Counters, time per phase and latency histograms of a run.
+
+    Everything is plain dictionary updates so that it can stay enabled:
+    phases are timed per batch, not per entry. Phases may overlap (eg: the
+    walk is interleaved with the filtering of its batches), the time of each
+    one only counts its own work.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self.counters = collections.Counter()
+        self.phase_seconds = collections.defaultdict(float)
+        # Histograms of latencies in buckets of powers of two microseconds,
+        # with their count, sum and maximum.
+        self.histograms = collections.defaultdict(collections.Counter)
+        self.latencies = dict()
+        self.started = time.perf_counter()
+
+    def count(self, counter, n=1):
+        """Add n to counter."""
+        self.counters[counter] += n
+
+    def add_time(self, phase, seconds):
+        """Add seconds to the time spent in phase."""
+        self.phase_seconds[phase] += seconds
+
+    def observe(self, histogram, seconds):
+        """Record a latency (in seconds) in histogram."""
+        # Bucket k holds the latencies up to 2**k microseconds.
+        self.histograms[histogram][int(seconds * 1e6).bit_length()] += 1
+        count, total, maximum = self.latencies.get(histogram, (0, 0.0, 0.0))
+        self.latencies[histogram] = (count + 1, total + seconds,
+                                     max(maximum, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Context manager adding the time spent in its block to phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[phase] += time.perf_counter() - start
+
+    def timed(self, phase, iterable):
+        """Yield from iterable adding the time spent getting items to phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.phase_seconds[phase] += time.perf_counter() - start
+            yield item
+
+    def as_dict(self):
+        """Return everything recorded as a JSON serializable dictionary."""
+        histograms = dict()
+        for name, buckets in self.histograms.items():
+            count, total, maximum = self.latencies[name]
+            histograms[name] = {
+                'count': count,
+                'sum_seconds': total,
+                'max_seconds': maximum,
+                'buckets_us': {str(2**k): buckets[k]
+                               for k in sorted(buckets)},
+            }
+        return {
+            'wall_seconds': time.perf_counter() - self.started,
+            'phase_seconds': dict(self.phase_seconds),
+            'counters': dict(self.counters),
+            'histograms': histograms,
+        }
+
+
+# Statistics of the current run.
+run_stats = RunStats()
+
+
+# Splits a basename into runs of non allowed chars, of underscores and of the
+# remaining allowed chars. primitive_name works on these runs instead of
+# rescanning the whole string once per rule.
+_NAME_TOKEN_REGEX = re.compile(
+    r'([^0-9a-zA-Z_.]+)'  # Non allowed chars.
+    r'|(_+)'              # Underscores.
+    r'|([0-9a-zA-Z.]+)')  # Other allowed chars.
+
+
+def normalize_basename(basename):
+    """Normalize a basename according to the primitive name rules.
+
+    The rules are applied in a single scan of basename:
+        1) Sequences of non allowed chars next to an underscore are removed.
+        2) Leading sequences of non allowed chars are removed.
+        3) Other sequences of non allowed chars become an underscore.
+        4) Underscores right before the extension are removed.
+        5) Trailing underscores are removed.
+        6) Sequences of underscores become a single one except at the start.
+
+    Arguments:
+        basename (str): lower case basename to be normalized.
+
+    Returns:
+        str: normalized basename.
+
+    Examples:
+        >>> normalize_basename('#1811_zz123123 adfadf __12_')
+        '1811_zz123123_adfadf_12'
+
+    """
+    tokens = _NAME_TOKEN_REGEX.findall(basename)
+    # Runs of the name after rules 1 to 3 as [is_underscore, text] pairs.
+    runs = []
+    # Index of the last run containing a '.', whether that '.' starts the run
+    # and whether there is any char after that '.' in the name.
+    last_dot_run = None
+    last_dot_starts_run = False
+    chars_after_last_dot = False
+    for index, (not_allowed, underscores, others) in enumerate(tokens):
+        if not_allowed:
+            if (index == 0
+                    or tokens[index - 1][1]
+                    or (index + 1 < len(tokens) and tokens[index + 1][1])):
+                continue
+            underscores = '_'
+        if underscores:
+            if runs and runs[-1][0]:
+                runs[-1][1] += underscores
+            else:
+                runs.append([True, underscores])
+            chars_after_last_dot = True
+        else:
+            dot_position = others.rfind('.')
+            if dot_position == -1:
+                chars_after_last_dot = True
+            else:
+                last_dot_run = len(runs)
+                last_dot_starts_run = dot_position == 0
+                chars_after_last_dot = dot_position < len(others) - 1
+            runs.append([False, others])
+    # Rule 4: only when the last '.' starts its run it can follow underscores.
+    if last_dot_starts_run and chars_after_last_dot and last_dot_run > 0:
+        del runs[last_dot_run - 1]
+    # Rule 5.
+    if runs and runs[-1][0]:
+        runs.pop()
+    if not runs:
+        return '_'
+    # Rule 6.
+    if runs[0][0]:
+        leading = runs.pop(0)[1]
+    else:
+        leading = ''
+    rest = ''.join('_' if x[0] else x[1] for x in runs)
+    if leading and len(rest) == 1:
+        # A single char after the leading underscores is not matched by the
+        # rule so it is separated by an extra underscore.
+        return leading + '_' + rest
+    return leading + rest
+
+
+def _transform_basename(basename):
+    # Transliterate Unicode text into plain 7-bit ASCII if 'unidecode' module
+    # is present.
+    return normalize_basename(unidecode(basename).lower())
+
+
+# Number of basenames whose primitive name is memoized by default.
+DEFAULT_NAME_CACHE_SIZE = 2 ** 16
+
+_cached_transform_basename = functools.lru_cache(
+    maxsize=DEFAULT_NAME_CACHE_SIZE)(_transform_basename)
+
+
+def set_name_cache_size(maxsize):
+    """Set the number of basenames memoized by primitive_name.
+
+    The cache is emptied and its statistics are reset.
+
+    Arguments:
+        maxsize (int): maximum number of cached basenames. 0 disables the
+            cache and None makes it unbounded.
+
+    """
+    global _cached_transform_basename
+    _cached_transform_basename = functools.lru_cache(
+        maxsize=maxsize)(_transform_basename)
+
+
+def name_cache_info():
+    """Return the hits, misses, maxsize and currsize of the name cache."""
+    return _cached_transform_basename.cache_info()
 
 
 # TODO: prefix iso mod date is a different function. Move it to another one.
@@ -42,33 +298,9 @@ def primitive_name(x):
         __pyname__
 
     """
-    # Transliterate Unicode text into plain 7-bit ASCII if 'unicode' module is
-    # present.
-    basename = unidecode(os.path.basename(x)).lower()
-    basename = re.sub(
-        '''(?<=_)[^0-9a-zA-Z\_\.]+      # Match all non allowed chars
-                                        # preceded by underline...
-            |                           # ... or ...
-            [^0-9a-zA-Z\_\.]+(?=_)''',  # All non allowed chars followed by
-                                        # an underline.
-        '',
-        basename,
-        flags=(re.VERBOSE))
-    # Removes the leading chars if it is a symbol.
-    basename = re.sub('^[^0-9a-zA-Z\_\.]+', '', basename)
-    # Removes any sequence of non underscore chars for an underscore.
-    basename = re.sub('[^0-9a-zA-Z\_\.]+', '_', basename)
-    # Removes any trailings '_' before extension.
-    basename = re.sub('_+(?=\.[^.]+$)', '', basename)
-    # Removes any trailing '_'.
-    basename = re.sub('_+$', '', basename)
-    # TODO: improve the following obscure regex substitution.
-    # Removes any sequence of '_' except at the start of the string.
-    basename = re.search('^_*', basename).group()                             \
-               + re.sub('_+', '_',
-                        re.sub('(_*)([^_].+)', '\\2', basename))
-    if basename == '':
-        basename = '_'
+    # Basenames repeat a lot across directories so their transformation is
+    # memoized.
+    basename = _cached_transform_basename(os.path.basename(x))
     return os.path.join(os.path.dirname(x), basename)
 
 
@@ -103,32 +335,298 @@ def add_trailing_number(iterable_of_strs, suffix='_', n=None):
                enumerate(iterable_of_strs))
 
 
-def prefix_iso_mod_date(file_path):
-    """Prefix a filepath with a 'YYYY_MM_DD_' prefix according to mod date.
+# Local calendar days whose prefix was already formatted: sorted lists of
+# their first timestamps, of the first timestamps of the following days and
+# of their prefixes.
+_day_starts = []
+_day_ends = []
+_day_prefixes = []
+_ISO_PREFIX_REGEX = re.compile('^[0-9]{8}_')
+
+
+def _iso_date_prefix(mtime):
+    """Return the 'YYYYMMDD_' prefix of the local date of timestamp mtime.
+
+    The prefix is formatted once per calendar day: later timestamps of the
+    same day are found with a binary search over the known days.
+
+    """
+    position = bisect.bisect_right(_day_starts, mtime) - 1
+    if position >= 0 and mtime < _day_ends[position]:
+        return _day_prefixes[position]
+    day = datetime.datetime.fromtimestamp(mtime).date()
+    prefix = day.strftime('%Y%m%d_')
+    start = datetime.datetime.combine(day, datetime.time()).timestamp()
+    end = datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time()).timestamp()
+    # Days whose bounds do not exist in local time are not kept.
+    if start <= mtime < end:
+        position = bisect.bisect_right(_day_starts, start)
+        _day_starts.insert(position, start)
+        _day_ends.insert(position, end)
+        _day_prefixes.insert(position, prefix)
+    return prefix
+
+
+def prefix_iso_mod_date(file_path, mtime=None):
+    """Prefix a filepath with a 'YYYYMMDD_' prefix according to mod date.
+
+    A 'YYYYMMDD_' prefix already present is replaced.
 
     Arguments:
         file_path (str): string to have a prefix added to.
+        mtime (float): modification time of file_path. It is read from the
+            file if not given.
 
     Returns:
         str: string with prepended prefix.
 
     Examples:
         >>> prefix_iso_mod_date('/tmp/dummy.txt')
-        '/tmp/2017_01_01_dummy.txt'
+        '/tmp/20170101_dummy.txt'
 
     """
+    if mtime is None:
+        mtime = os.path.getmtime(file_path)
     basename = os.path.basename(file_path)
-    iso_prefix = re.search('^[0-9]{8}_', basename)
-    time = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
-    if iso_prefix is None:
-        basename = time.strftime('%Y%m%d_') + basename
+    if _ISO_PREFIX_REGEX.match(basename):
+        basename = basename[9:]
+    return os.path.join(os.path.dirname(file_path),
+                        _iso_date_prefix(mtime) + basename)
+
+
+def prefix_iso_mod_dates(entries, paths=None):
+    """Compute prefix_iso_mod_date for the files among a batch of entries.
+
+    The modification times come from the stat results cached by the
+    entries (see PathEntry), so each file is stat at most once.
+
+    Arguments:
+        entries (list): PathEntry of the paths.
+        paths (list): paths to be prefixed instead of the paths of entries,
+            eg: their new names.
+
+    Returns:
+        list: the prefixed paths. Directories are not prefixed.
+
+    """
+    if paths is None:
+        paths = [x.path for x in entries]
+    prefixed_paths = []
+    for one_entry, one_path in zip(entries, paths):
+        if one_entry.is_file():
+            try:
+                one_path = prefix_iso_mod_date(one_path,
+                                               one_entry.stat().st_mtime)
+            except OSError:
+                # Gone: renaming it will fail anyway.
+                pass
+        prefixed_paths.append(one_path)
+    return prefixed_paths
+
+
+# Numbered backreferences (and conditionals) would point to another group once
+# a pattern is combined with others.
+_NUMBERED_GROUP_REFERENCE_REGEX = re.compile(r'\\[1-9]|\(\?\(\d')
+# Constructs which look at what follows the match: '$', '\Z', '\b', '\B' and
+# lookaheads. A pattern without them found in a path is also found in any
+# path starting with it.
+_LOOKS_AHEAD_REGEX = re.compile(r'\$|\\[ZbB]|\(\?[=!]')
+
+
+class ExcludeMatcher(object):
+    """Match paths against a list of exclude patterns in a single search.
+
+    Patterns which are plain literals, optionally anchored at the start or
+    at the end of the path (eg: '.*\\.git.*' or '^/tmp/'), are checked with
+    string operations. The remaining ones are combined into one alternation
+    so each path is searched once instead of once per pattern. Patterns
+    which cannot be safely combined (compiled with flags, with global inline
+    flags or with numbered backreferences) are searched on their own.
+
+    Arguments:
+        patterns (iterable): exclude patterns as strings or compiled regexes.
+
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(x) for x in patterns]
+        default_flags = re.compile('').flags
+        literals = {'literal': [], 'prefix': [], 'suffix': [], 'exact': []}
+        kinds = collections.Counter()
+        regexes = []
+        for pattern in self.patterns:
+            classified = None
+            if pattern.flags == default_flags:
+                classified = _classify_pattern(pattern.pattern)
+            if classified is None:
+                regexes.append(pattern)
+            else:
+                kinds[classified[0]] += 1
+                literals[classified[0]].extend(classified[1])
+        self._literals = tuple(literals['literal'])
+        self._prefixes = tuple(literals['prefix'])
+        self._suffixes = tuple(literals['suffix'])
+        self._exacts = frozenset(literals['exact'])
+        self._combined, self._separate = _combine_patterns(regexes)
+        # Patterns which, when found in a directory path, are also found in
+        # the path of everything below it.
+        self._subtree_combined, self._subtree_separate = _combine_patterns(
+            [x for x in regexes if not _LOOKS_AHEAD_REGEX.search(x.pattern)])
+        logging.debug(
+            'Exclude patterns: {0} literal, {1} prefix, {2} suffix, '
+            '{3} exact, {4} combined, {5} separate.'.format(
+                kinds['literal'], kinds['prefix'], kinds['suffix'],
+                kinds['exact'], len(regexes) - len(self._separate),
+                len(self._separate)))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _excludes_by_literal(self, path):
+        if self._prefixes and path.startswith(self._prefixes):
+            return True
+        for literal in self._literals:
+            if literal in path:
+                return True
+        return False
+
+    def excludes(self, path):
+        """Return True if any of the patterns is found in path."""
+        if self._excludes_by_literal(path):
+            return True
+        if self._suffixes and path.endswith(self._suffixes):
+            return True
+        if path in self._exacts:
+            return True
+        if self._combined is not None and self._combined.search(path):
+            return True
+        return any(x.search(path) for x in self._separate)
+
+    def excludes_subtree(self, path):
+        """Return True if path and every path below it are excluded."""
+        if self._excludes_by_literal(path):
+            return True
+        if (self._subtree_combined is not None
+                and self._subtree_combined.search(path)):
+            return True
+        return any(x.search(path) for x in self._subtree_separate)
+
+    def matching_pattern(self, path):
+        """Return the first pattern found in path or None."""
+        for pattern in self.patterns:
+            if pattern.search(path):
+                return pattern
+        return None
+
+
+# Chars with a special meaning in a regex. When escaped they are literals.
+_REGEX_METACHARS = frozenset('.^$*+?{}[]|()')
+
+
+def _tokenize_pattern(pattern):
+    """Split a regex in (is_literal, text) tokens with escapes resolved."""
+    tokens = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, '')
+            if escaped == '' or escaped.isalnum():
+                # Eg: '\\d' or '\\A'.
+                tokens.append((False, char + escaped))
+            else:
+                tokens.append((True, escaped))
+        else:
+            tokens.append((char not in _REGEX_METACHARS, char))
+    return tokens
+
+
+def _classify_pattern(pattern):
+    """Reduce a regex to a string test if it only looks for a literal.
+
+    Arguments:
+        pattern (str): regex without flags.
+
+    Returns:
+        tuple: (kind, strings) where kind is 'literal', 'prefix', 'suffix' or
+            'exact' (the regex is found in a path if it contains, starts
+            with, ends with or is one of strings respectively) or None if the
+            regex is not that simple.
+
+    """
+    tokens = _tokenize_pattern(pattern)
+    anchored_start = bool(tokens) and tokens[0] in ((False, '^'),
+                                                    (False, '\\A'))
+    if anchored_start:
+        del tokens[0]
+    anchored_end = None
+    if tokens and tokens[-1] in ((False, '$'), (False, '\\Z')):
+        anchored_end = tokens.pop()[1]
+    # A '.*' next to an unanchored side may match nothing so it does not
+    # change whether the regex is found.
+    any_chars = [(False, '.'), (False, '*')]
+    lazy_any_chars = any_chars + [(False, '?')]
+    while not anchored_start:
+        if tokens[:3] == lazy_any_chars:
+            del tokens[:3]
+        elif tokens[:2] == any_chars:
+            del tokens[:2]
+        else:
+            break
+    while anchored_end is None:
+        if tokens[-3:] == lazy_any_chars:
+            del tokens[-3:]
+        elif tokens[-2:] == any_chars:
+            del tokens[-2:]
+        else:
+            break
+    if not all(x[0] for x in tokens):
+        return None
+    literal = ''.join(x[1] for x in tokens)
+    # '$' also matches before a newline ending the string.
+    if anchored_end == '$':
+        literals = (literal, literal + '\n')
     else:
-        if iso_prefix.groups(0) != time.strftime('%Y%m%d_'):
-            basename = time.strftime('%Y%m%d_') + basename[9:]
+        literals = (literal, )
+    if anchored_start and anchored_end:
+        return 'exact', literals
+    elif anchored_start:
+        return 'prefix', literals
+    elif anchored_end:
+        return 'suffix', literals
+    return 'literal', literals
+
+
+def _combine_patterns(patterns):
+    """Return an alternation of patterns and the ones left out of it."""
+    default_flags = re.compile('').flags
+    combinable = []
+    separate = []
+    for pattern in patterns:
+        if (pattern.flags == default_flags
+                and _can_be_grouped(pattern.pattern)
+                and not (pattern.groups
+                         and _NUMBERED_GROUP_REFERENCE_REGEX.search(
+                             pattern.pattern))):
+            combinable.append(pattern)
         else:
-            basename = time.strftime('%Y%m%d_') + basename
+            separate.append(pattern)
+    if not combinable:
+        return None, separate
+    try:
+        return re.compile('|'.join(
+            '(?:{0})'.format(x.pattern) for x in combinable)), separate
+    except re.error:
+        # Eg: the same group name used in two patterns.
+        return None, list(patterns)
+
 
-    return os.path.join(os.path.dirname(file_path), basename)
+def _can_be_grouped(pattern):
+    try:
+        re.compile('(?:{0})'.format(pattern))
+    except re.error:
+        return False
+    return True
 
 
 def filter_out_paths_to_be_renamed(
@@ -139,39 +637,133 @@ def filter_out_paths_to_be_renamed(
     u"""Remove paths that need not to be renamed from a list.
 
     Arguments:
-        list_of_paths (list): list of valid paths to be filtered.
+        list_of_paths (list): list of PathEntry of valid paths to be filtered.
         compiled_regex_to_trigger_renaming (compiled re object):
             compiled object whose search method should yield True for objects
             to be renamed.
-        list_of_excluding_regex_patterns (list): list of patterns to remove a
-            given path from the renaming process.
+        list_of_excluding_regex_patterns (ExcludeMatcher): patterns to remove
+            a given path from the renaming process. A list of patterns is
+            also accepted.
 
     Returns:
-        list: A list contaning paths to be renamed.
+        list: A list contaning the PathEntry of paths to be renamed.
 
     """
-    paths_to_rename = filter(
-        lambda x: compiled_regex_to_trigger_renaming.search(
-            os.path.basename(x)),
-        list_of_paths)
+    start = time.perf_counter()
+    run_stats.count('entries_scanned', len(list_of_paths))
     if prefixisomoddate:
         has_not_prefixisomoddate_regex = re.compile('^(?![0-9]{8}_)')
-        paths_to_rename_prefixidomoddate = filter(
-            has_not_prefixisomoddate_regex.search,
+        # A single pass keeps each entry once and in order.
+        paths_to_rename = [
+            x for x in list_of_paths
+            if compiled_regex_to_trigger_renaming.search(x.name)
+            or has_not_prefixisomoddate_regex.search(x.path)]
+        # This sorting makes sure files are processed first. The sort is
+        # stable and the entries already know their type so no extra stat is
+        # needed.
+        paths_to_rename.sort(key=lambda x: x.is_file(), reverse=True)
+    else:
+        paths_to_rename = filter(
+            lambda x: compiled_regex_to_trigger_renaming.search(x.name),
             list_of_paths)
-        # This allows directories to come before files.
-        paths_to_rename = set(paths_to_rename) \
-                          | set(paths_to_rename_prefixidomoddate)  # noqa
-        # This sorting makes sure files are processed first. Apply set to
-        # variables disarranges the order.
-        paths_to_rename = sorted(paths_to_rename, key=os.path.isfile,
-                                 reverse=True)
+    if isinstance(list_of_excluding_regex_patterns, ExcludeMatcher):
+        exclude_matcher = list_of_excluding_regex_patterns
+    else:
+        exclude_matcher = ExcludeMatcher(list_of_excluding_regex_patterns)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     # Keep the entry if the exclude pattern search finds nothing.
-    for exclude_pattern in list_of_excluding_regex_patterns:
-        paths_to_rename = [
-            x for x in paths_to_rename if exclude_pattern.search(x) is None
-        ]
-    return paths_to_rename
+    filtered_paths = []
+    n_excluded = 0
+    for one_path in paths_to_rename:
+        if not exclude_matcher.excludes(one_path.path):
+            filtered_paths.append(one_path)
+            continue
+        n_excluded += 1
+        if debug:
+            logging.debug('Excluded \'{0}\' (pattern: \'{1}\').'.format(
+                one_path.path,
+                exclude_matcher.matching_pattern(one_path.path).pattern))
+    run_stats.count('entries_excluded', n_excluded)
+    run_stats.count('entries_to_rename', len(filtered_paths))
+    run_stats.add_time('filter', time.perf_counter() - start)
+    return filtered_paths
+
+
+# renameat2 from the C library (Linux) as a (function, get_errno) tuple. It is
+# loaded on first use: None means not loaded yet and False not available.
+_renameat2 = None
+# Flag of renameat2 making the call fail if the destination exists.
+_RENAME_NOREPLACE = 1
+# Value of dirfd making renameat2 resolve relative paths from the cwd.
+_AT_FDCWD = -100
+
+
+def _get_renameat2():
+    global _renameat2
+    if _renameat2 is None:
+        _renameat2 = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                function = ctypes.CDLL(None, use_errno=True).renameat2
+            except (ImportError, OSError, AttributeError):
+                logging.debug('renameat2 is not available.')
+            else:
+                function.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_int, ctypes.c_char_p,
+                                     ctypes.c_uint)
+                function.restype = ctypes.c_int
+                _renameat2 = (function, ctypes.get_errno)
+    return _renameat2
+
+
+def rename_no_replace(src, dst, dir_fd=None):
+    """Rename src to dst unless dst already exists.
+
+    On Linux this is a single atomic ``renameat2`` call with the
+    RENAME_NOREPLACE flag. Elsewhere, or if the filesystem of src does not
+    support that flag, dst is checked with ``os.lstat`` before
+    ``os.rename``.
+
+    Arguments:
+        src (str): path to be renamed.
+        dst (str): new path of src.
+        dir_fd (int): file descriptor of a directory. If given src and dst
+            are relative to it.
+
+    Raises:
+        FileExistsError: if dst exists.
+        OSError: if the renaming fails (errno EXDEV if src and dst are on
+            different filesystems).
+
+    """
+    global _renameat2
+    renameat2 = _get_renameat2()
+    if renameat2:
+        function, get_errno = renameat2
+        fd = _AT_FDCWD if dir_fd is None else dir_fd
+        if function(fd, os.fsencode(src), fd, os.fsencode(dst),
+                    _RENAME_NOREPLACE) == 0:
+            return None
+        error = get_errno()
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(error, os.strerror(error), src, None, dst)
+        logging.debug('renameat2 failed: {0}. Using os.rename.'.format(
+            os.strerror(error)))
+        # Without the system call in the kernel it is not tried again. The
+        # filesystem of this renaming may not support the flag (EINVAL), but
+        # others might: only this renaming falls back to os.rename.
+        if error == errno.ENOSYS:
+            _renameat2 = False
+    try:
+        os.lstat(dst, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+    else:
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                              src, None, dst)
+    os.rename(src, dst, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    return None
 
 
 def do_the_renaming(old_names, new_names, history_file):
@@ -192,18 +784,286 @@ def do_the_renaming(old_names, new_names, history_file):
     pass
 
 
+class PathEntry(object):
+    """Path found while walking a tree, with its type and stat cached.
+
+    Mimics the part of the ``os.DirEntry`` interface used by this program. It
+    wraps the ``os.DirEntry`` yielded by ``os.scandir`` when there is one (so
+    the file type comes for free from the directory listing) and falls back
+    to a single ``os.stat`` call for paths given by the user.
+
+    Entries found by walk_entries also know the names of every entry in
+    their directory (siblings), which is None for paths given by the user.
+
+    Arguments:
+        path (str): path of the entry.
+        dir_entry (os.DirEntry): entry from ``os.scandir`` for this path.
+
+    """
+
+    __slots__ = ('path', 'name', 'siblings', '_dir_entry', '_stat')
+
+    def __init__(self, path, dir_entry=None):
+        self.path = path
+        self.name = (os.path.basename(path) if dir_entry is None
+                     else dir_entry.name)
+        self.siblings = None
+        self._dir_entry = dir_entry
+        self._stat = None
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(type(self).__name__, self.path)
+
+    def stat(self):
+        """Return the (cached) stat result of this entry."""
+        if self._stat is None:
+            if self._dir_entry is None:
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._dir_entry.stat()
+        return self._stat
+
+    def _has_mode(self, test_mode):
+        try:
+            return test_mode(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self):
+        """Return True if this entry is a directory (following symlinks)."""
+        if self._dir_entry is None:
+            return self._has_mode(stat.S_ISDIR)
+        try:
+            return self._dir_entry.is_dir()
+        except OSError:
+            return False
+
+    def is_file(self):
+        """Return True if this entry is a file (following symlinks)."""
+        if self._dir_entry is None:
+            return self._has_mode(stat.S_ISREG)
+        try:
+            return self._dir_entry.is_file()
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        """Return True if this entry is a symbolic link."""
+        if self._dir_entry is None:
+            return os.path.islink(self.path)
+        try:
+            return self._dir_entry.is_symlink()
+        except OSError:
+            return False
+
+
+def _scan_directory(path):
+    """Return the entries of directory path as a list of PathEntry."""
+    with os.scandir(path) as iterator:
+        children = [PathEntry(x.path, x) for x in iterator]
+    # A single set of names is shared by all the children (and kept up to
+    # date by whoever renames them).
+    siblings = set(x.name for x in children)
+    for one_child in children:
+        one_child.siblings = siblings
+    return children
+
+
+# Directories listed in advance by each worker of walk_entries.
+WALK_SCAN_AHEAD = 4
+
+
+def walk_entries(top, topdown=False, onerror=None, prune=None, workers=1):
+    """Walk the tree rooted at top reading each directory exactly once.
+
+    This is a ``os.scandir`` based replacement for ``os.walk``: instead of
+    names it yields PathEntry objects which carry the file type (and stat,
+    once requested) from the directory listing. As with ``os.walk`` symbolic
+    links to directories are listed but not descended into.
+
+    Arguments:
+        top (str): the path of the directory to walk.
+        topdown (bool): yield a directory before its subdirectories if True,
+            after them otherwise (bottom-up, the default).
+        onerror (callable): called with the OSError instance if a directory
+            cannot be listed. By default errors are ignored.
+        prune (callable): called with the PathEntry of each subdirectory. If
+            it returns True the subdirectory is neither descended into nor
+            yielded.
+        workers (int): number of threads listing directories. With more than
+            one the next directories to be walked (up to WALK_SCAN_AHEAD per
+            worker) are listed concurrently, which pays off on high latency
+            filesystems, while the order of the walk stays the same.
+
+    Returns:
+        generator: (directory, children) tuples where directory is the
+            PathEntry of the directory and children is the list of PathEntry
+            found in it.
+
+    """
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    # Listings being made by the workers, by directory. Only the next
+    # directories to be walked are listed in advance, so the listings held
+    # in memory are bounded however wide the tree is.
+    scans = dict()
+    max_scans = workers * WALK_SCAN_AHEAD
+
+    def schedule_next_scans():
+        n_unscanned = 0
+        position = len(stack) - 1
+        while (len(scans) < max_scans and n_unscanned < max_scans
+               and position >= 0):
+            directory, children = stack[position]
+            if children is None:
+                n_unscanned += 1
+                if directory not in scans:
+                    scans[directory] = executor.submit(_scan_directory,
+                                                       directory.path)
+            position -= 1
+
+    # Each item is a directory and its children or None if it still has to
+    # be scanned. Bottom-up walks push the scanned directory back so it is
+    # yielded after all of its subdirectories.
+    stack = [(PathEntry(top), None)]
+    try:
+        while stack:
+            directory, children = stack.pop()
+            if children is not None:
+                yield directory, children
+                continue
+            try:
+                scan = scans.pop(directory, None)
+                if scan is None:
+                    children = _scan_directory(directory.path)
+                else:
+                    children = scan.result()
+            except OSError as error:
+                if onerror is not None:
+                    onerror(error)
+                continue
+            if topdown:
+                yield directory, children
+            else:
+                stack.append((directory, children))
+            subdirectories = [
+                (x, None) for x in children
+                if x.is_dir() and not x.is_symlink()
+                and not (prune is not None and prune(x))]
+            stack.extend(reversed(subdirectories))
+            if executor is not None:
+                schedule_next_scans()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def walk_entries_in_chunks(top, chunk_size, onerror=None, prune=None):
+    """Walk the tree rooted at top holding a bounded number of entries.
+
+    The files of each directory are yielded in chunks while the directory is
+    being listed and the directory itself is yielded on its own after its
+    files and its subdirectories. Only the subdirectories found are kept in
+    memory, so a directory with millions of files takes as much memory as a
+    chunk. The entries found have no siblings.
+
+    Arguments:
+        top (str): the path of the directory to walk.
+        chunk_size (int): maximum number of entries in each chunk.
+        onerror (callable): see walk_entries.
+        prune (callable): see walk_entries.
+
+    Returns:
+        generator: lists of at most chunk_size PathEntry.
+
+    """
+    # Each item is a directory and whether it was already listed.
+    stack = [(PathEntry(top), False)]
+    while stack:
+        directory, listed = stack.pop()
+        if listed:
+            yield [directory]
+            continue
+        subdirectories = []
+        chunk = []
+        try:
+            with os.scandir(directory.path) as iterator:
+                stack.append((directory, True))
+                for dir_entry in iterator:
+                    one_entry = PathEntry(dir_entry.path, dir_entry)
+                    if not one_entry.is_dir():
+                        chunk.append(one_entry)
+                        if len(chunk) >= chunk_size:
+                            yield chunk
+                            chunk = []
+                    elif not one_entry.is_symlink() and not (
+                            prune is not None and prune(one_entry)):
+                        subdirectories.append((one_entry, False))
+        except OSError as error:
+            if onerror is not None:
+                onerror(error)
+        if chunk:
+            yield chunk
+        stack.extend(reversed(subdirectories))
+
+
 def directory_generation_starting_from_files(
         list_of_files,
-        list_of_directories_to_recurse):
-    u"""Return a single generator starting from files then folders."""
+        list_of_directories_to_recurse,
+        exclude_matcher=None,
+        walk_workers=1,
+        skip_subtree=None,
+        onerror=None,
+        chunk_size=None):
+    u"""Return a single generator starting from files then folders.
+
+    Every item is a list of PathEntry: first each of list_of_files on its own
+    then, for each directory in list_of_directories_to_recurse, the files of
+    every subdirectory followed by the subdirectory itself (bottom-up).
+
+    If exclude_matcher (ExcludeMatcher) is given directories whose whole
+    subtree is excluded are not walked at all, and neither are directories
+    for which skip_subtree (callable) returns True. Directories are listed by
+    walk_workers threads and listing errors are passed to onerror (see
+    walk_entries).
+
+    If chunk_size is given the directories are walked with
+    walk_entries_in_chunks instead (and walk_workers is not used): the files
+    of each directory come in lists of at most chunk_size entries and the
+    directory in a list of its own.
+
+    """
+    if exclude_matcher is None and skip_subtree is None:
+        prune = None
+    else:
+        def prune(entry):
+            if (exclude_matcher is not None
+                    and exclude_matcher.excludes_subtree(entry.path)):
+                logging.debug('Not walking excluded \'{0}\'.'.format(
+                    entry.path))
+                run_stats.count('directories_excluded')
+                return True
+            return skip_subtree is not None and skip_subtree(entry)
     for one_file in list_of_files:
         # In order to achieve consistency return a list of a single item.
         # Otherwise returning a string could mess with the functions that
         # iterate over an entry.
-        yield [one_file]
+        yield [PathEntry(one_file)]
     for one_dir in list_of_directories_to_recurse:
-        for dirpath, _, filenames in os.walk(one_dir, topdown=False):
-            yield [os.path.join(dirpath, fn) for fn in filenames] + [dirpath]
+        if prune is not None and prune(PathEntry(one_dir)):
+            continue
+        if chunk_size:
+            yield from walk_entries_in_chunks(one_dir, chunk_size,
+                                              onerror=onerror, prune=prune)
+            continue
+        for directory, children in walk_entries(one_dir, onerror=onerror,
+                                                prune=prune,
+                                                workers=walk_workers):
+            yield [x for x in children if not x.is_dir()] + [directory]
 
 
 def generate_folder_structure(top):
@@ -220,21 +1080,470 @@ def generate_folder_structure(top):
         generator: a generator containing all files found recursively on top.
 
     """
-    walk_w_folders = filter(
-        lambda x: x[1],
-        os.walk(top))
-    for has_directory in walk_w_folders:
-        for one_directory in has_directory[1]:
-            yield os.path.join(has_directory[0], one_directory)
-
-    walk_w_files = filter(
-        lambda x: x[2],
-        os.walk(top))
-    for has_file in walk_w_files:
-        for one_file in has_file[2]:
-            yield os.path.join(has_file[0], one_file)
+    # Subfolders are yielded as they are found; files are kept until the
+    # single walk is over.
+    files = []
+    for _, children in walk_entries(top, topdown=True):
+        for one_entry in children:
+            if one_entry.is_dir():
+                yield one_entry.path
+            else:
+                files.append(one_entry.path)
+    yield from files
     return None
 
 
+# Directories modified less than this (in nanoseconds) ago may be modified
+# again without changing their modification time.
+MTIME_RESOLUTION_NS = 2 * 10**9
+
+# New files never opened (eg: made with mknod) and new directories are
+# reported once nothing happened to them for this many seconds.
+NEW_PATH_SETTLE_DELAY = 1.0
+
+# inotify constants (see inotify(7)).
+_IN_CLOSE_WRITE = 0x8
+_IN_OPEN = 0x20
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_ISDIR = 0x40000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def _paths_in_tree(paths, top):
+    return [x for x in paths if x == top or x.startswith(top + os.sep)]
+
+
+class InotifyWatcher(object):
+    """Report the paths created in or moved into directory trees.
+
+    Every directory of the trees is watched with inotify (through ctypes, so
+    it is only available on Linux). New directories are watched as soon as
+    their creation is read and directories renamed or moved within the trees
+    keep being watched under their new path.
+
+    Nothing is reported while a program may still be writing it: new files
+    once they are closed after writing (or NEW_PATH_SETTLE_DELAY seconds
+    after their creation if they are not opened) and new directories once no
+    file of their tree is being written and nothing happened in it for
+    NEW_PATH_SETTLE_DELAY seconds.
+
+    Arguments:
+        roots (list): directories whose trees are watched.
+        prune (callable): called with the PathEntry of each subdirectory. If
+            it returns True its tree is not watched.
+
+    Raises:
+        OSError: if inotify is not available or a directory cannot be
+            watched (eg: the limit of watches of the user was reached).
+
+    """
+
+    def __init__(self, roots, prune=None):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            inotify_init1 = libc.inotify_init1
+        except (ImportError, AttributeError) as error:
+            raise OSError(errno.ENOSYS, str(error))
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self._get_errno = ctypes.get_errno
+        self._fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = self._get_errno()
+            raise OSError(error, os.strerror(error))
+        self.roots = list(roots)
+        self._prune = prune
+        # Path of each watch descriptor and the other way around.
+        self._paths = dict()
+        self._watches = dict()
+        # New files not yet opened, with the time they were created, and new
+        # files not yet closed after writing.
+        self._files_created = dict()
+        self._files_being_written = set()
+        # New directories not reported yet, with the time of the last event
+        # in their trees.
+        self._new_directories = dict()
+        try:
+            for root in self.roots:
+                self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._watches)
+
+    def close(self):
+        """Stop watching."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _watch_tree(self, top, new=False):
+        for directory, children in walk_entries(top, topdown=True,
+                                                prune=self._prune):
+            wd = self._add_watch(
+                self._fd, os.fsencode(directory.path),
+                _IN_CREATE | _IN_OPEN | _IN_CLOSE_WRITE | _IN_DELETE
+                | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_ONLYDIR
+                | _IN_DONT_FOLLOW)
+            if wd < 0:
+                error = self._get_errno()
+                if error == errno.ENOENT:
+                    # Removed since it was listed.
+                    continue
+                # The new files of a directory not watched would be
+                # silently ignored.
+                raise OSError(error, 'Cannot watch directory: {0}'.format(
+                    os.strerror(error)), directory.path)
+            self._paths[wd] = directory.path
+            self._watches[directory.path] = wd
+            if new:
+                # The files of a new tree may have been opened before it was
+                # watched.
+                self._files_being_written.update(
+                    x.path for x in children if self._is_open_for_writing(x))
+
+    @staticmethod
+    def _may_be_written(path):
+        # Regular files are created by opening them, except for hard links.
+        # Paths already moved or removed are followed through their next
+        # events.
+        try:
+            path_stat = os.lstat(path)
+        except OSError:
+            return True
+        return stat.S_ISREG(path_stat.st_mode) and path_stat.st_nlink == 1
+
+    @staticmethod
+    def _is_open_for_writing(entry):
+        # A read lease cannot be taken on a file open for writing. Only the
+        # files modified lately are checked.
+        if entry.is_symlink() or not entry.is_file():
+            return False
+        try:
+            entry_stat = entry.stat()
+        except OSError:
+            return False
+        if (entry_stat.st_nlink != 1 or entry_stat.st_mtime_ns
+                < time.time_ns() - MTIME_RESOLUTION_NS):
+            return False
+        try:
+            import fcntl
+            fd = os.open(entry.path,
+                         os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+        except (ImportError, OSError):
+            return False
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETLEASE, fcntl.F_RDLCK)
+            fcntl.fcntl(fd, fcntl.F_SETLEASE, fcntl.F_UNLCK)
+        except OSError as error:
+            return error.errno == errno.EAGAIN
+        finally:
+            os.close(fd)
+        return False
+
+    def _move_tree(self, old_top, new_top):
+        for path in _paths_in_tree(self._watches, old_top):
+            wd = self._watches.pop(path)
+            path = new_top + path[len(old_top):]
+            self._paths[wd] = path
+            self._watches[path] = wd
+        for pending in (self._files_created, self._new_directories):
+            for path in _paths_in_tree(pending, old_top):
+                pending[new_top + path[len(old_top):]] = pending.pop(path)
+        for path in _paths_in_tree(self._files_being_written, old_top):
+            self._files_being_written.remove(path)
+            self._files_being_written.add(new_top + path[len(old_top):])
+
+    def _forget_tree(self, top):
+        for pending in (self._files_created, self._new_directories):
+            for path in _paths_in_tree(pending, top):
+                del pending[path]
+        self._files_being_written.difference_update(
+            _paths_in_tree(self._files_being_written, top))
+
+    def _unwatch_tree(self, top):
+        for path in _paths_in_tree(self._watches, top):
+            wd = self._watches.pop(path)
+            self._rm_watch(self._fd, wd)
+            del self._paths[wd]
+        self._forget_tree(top)
+
+    def _new_directories_of(self, path):
+        return [x for x in self._new_directories
+                if path.startswith(x + os.sep)]
+
+    def _report(self, path, new_paths):
+        # The paths inside new directories are reported with them.
+        if not self._new_directories_of(path):
+            new_paths.append(path)
+
+    def _file_event(self, path, mask, cookie, moved_files, new_paths):
+        if mask & _IN_CREATE:
+            if self._may_be_written(path):
+                self._files_created[path] = time.monotonic()
+            else:
+                self._report(path, new_paths)
+        elif mask & _IN_OPEN:
+            if self._files_created.pop(path, None) is not None:
+                self._files_being_written.add(path)
+        elif mask & _IN_CLOSE_WRITE:
+            if path in self._files_being_written:
+                self._files_being_written.remove(path)
+                self._report(path, new_paths)
+        elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+            being_written = path in self._files_being_written
+            self._files_created.pop(path, None)
+            self._files_being_written.discard(path)
+            if mask & _IN_MOVED_FROM:
+                moved_files[cookie] = being_written
+        elif mask & _IN_MOVED_TO:
+            if moved_files.pop(cookie, False):
+                self._files_being_written.add(path)
+            else:
+                self._report(path, new_paths)
+
+    def _read_events(self, new_paths):
+        data = b''
+        while True:
+            try:
+                data += os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+        # Directories moved from a watched directory, by event cookie, and
+        # whether the files moved were being written.
+        moved_from = dict()
+        moved_files = dict()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                logging.warning('Too many events: reporting the whole trees.')
+                new_paths.extend(self.roots)
+                continue
+            if mask & _IN_IGNORED:
+                path = self._paths.pop(wd, None)
+                if self._watches.get(path) == wd:
+                    del self._watches[path]
+                continue
+            if wd not in self._paths:
+                continue
+            path = os.path.join(self._paths[wd], name)
+            if not mask & _IN_OPEN:
+                # Opening paths (as done to list new directories) does not
+                # change the trees.
+                for directory in self._new_directories_of(path):
+                    self._new_directories[directory] = time.monotonic()
+            if not mask & _IN_ISDIR:
+                self._file_event(path, mask, cookie, moved_files, new_paths)
+                continue
+            if mask & _IN_MOVED_FROM:
+                moved_from[cookie] = path
+                continue
+            if mask & _IN_DELETE:
+                self._forget_tree(path)
+                continue
+            if not mask & (_IN_CREATE | _IN_MOVED_TO):
+                continue
+            if mask & _IN_MOVED_TO and cookie in moved_from:
+                self._move_tree(moved_from.pop(cookie), path)
+            elif not (self._prune is not None
+                      and self._prune(PathEntry(path))):
+                self._watch_tree(path, new=True)
+            if not self._new_directories_of(path):
+                self._new_directories[path] = time.monotonic()
+        # Directories moved out of the trees.
+        for path in moved_from.values():
+            self._unwatch_tree(path)
+
+    def _next_due(self):
+        # When the first path waiting for NEW_PATH_SETTLE_DELAY (and not for
+        # a file being written) is due, None if there is none.
+        being_written = list(self._files_created) + list(
+            self._files_being_written)
+        times = list(self._files_created.values()) + [
+            x[1] for x in self._new_directories.items()
+            if not _paths_in_tree(being_written, x[0])]
+        return min(times) + NEW_PATH_SETTLE_DELAY if times else None
+
+    def _pop_ready_paths(self, new_paths):
+        now = time.monotonic()
+        for path, created in list(self._files_created.items()):
+            if now - created >= NEW_PATH_SETTLE_DELAY:
+                del self._files_created[path]
+                self._report(path, new_paths)
+        being_written = list(self._files_created) + list(
+            self._files_being_written)
+        for path, last_event in list(self._new_directories.items()):
+            if (now - last_event >= NEW_PATH_SETTLE_DELAY
+                    and not _paths_in_tree(being_written, path)):
+                del self._new_directories[path]
+                new_paths.append(path)
+
+    def wait(self, timeout=None):
+        """Return the new paths reported within timeout seconds.
+
+        Only the topmost new path is reported for new trees: the paths inside
+        new directories may be created before these are watched. Files
+        created are reported when closed after writing, except for links,
+        and new directories once no file of their tree is being written.
+
+        Arguments:
+            timeout (float): seconds to wait for events. If None wait until
+                there is one.
+
+        Returns:
+            list: the new paths, empty if there were none.
+
+        Raises:
+            OSError: if a new directory cannot be watched.
+
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        new_paths = []
+        while True:
+            delay = None if end is None else max(0, end - time.monotonic())
+            due = self._next_due()
+            if due is not None:
+                due = max(0, due - time.monotonic())
+                delay = due if delay is None else min(delay, due)
+            if select.select([self._fd], [], [], delay)[0]:
+                self._read_events(new_paths)
+            self._pop_ready_paths(new_paths)
+            if new_paths or (end is not None and time.monotonic() >= end):
+                return new_paths
+
+
+class PollingWatcher(object):
+    """Report the paths created in or moved into directory trees by polling.
+
+    Portable replacement of InotifyWatcher: the modification time of every
+    directory is checked every interval seconds and only the directories
+    whose modification time changed are listed again.
+
+    Arguments:
+        roots (list): directories whose trees are watched.
+        prune (callable): see InotifyWatcher.
+        interval (float): seconds between checks.
+
+    """
+
+    def __init__(self, roots, prune=None, interval=1.0):
+        self.roots = list(roots)
+        self.interval = interval
+        self._prune = prune
+        # Modification time (None if it cannot be trusted) and names of each
+        # directory.
+        self._directories = dict()
+        for root in self.roots:
+            self._scan_tree(root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._directories)
+
+    def close(self):
+        """Stop watching."""
+        self._directories.clear()
+
+    def _scan(self, path):
+        """List path, recording it, and return its entries."""
+        # The modification time is read before listing so that changes made
+        # in between are found on the next check.
+        mtime = os.stat(path).st_mtime_ns
+        if mtime > time.time_ns() - MTIME_RESOLUTION_NS:
+            mtime = None
+        children = _scan_directory(path)
+        self._directories[path] = (mtime, set(x.name for x in children))
+        return children
+
+    def _subdirectories(self, children):
+        return [x.path for x in children
+                if x.is_dir() and not x.is_symlink()
+                and not (self._prune is not None and self._prune(x))]
+
+    def _scan_tree(self, top):
+        stack = [top]
+        while stack:
+            try:
+                children = self._scan(stack.pop())
+            except OSError:
+                continue
+            stack.extend(self._subdirectories(children))
+
+    def poll(self):
+        """Return the paths that appeared since the last check."""
+        new_paths = []
+        for path, (mtime, names) in list(self._directories.items()):
+            try:
+                if os.stat(path).st_mtime_ns == mtime:
+                    continue
+                children = self._scan(path)
+            except OSError:
+                # Removed or renamed: its new path is found in its parent.
+                del self._directories[path]
+                continue
+            new_children = [x for x in children if x.name not in names]
+            new_paths.extend(x.path for x in new_children)
+            for subdirectory in self._subdirectories(new_children):
+                self._scan_tree(subdirectory)
+        return new_paths
+
+    def wait(self, timeout=None):
+        """Return the new paths found within timeout seconds.
+
+        See InotifyWatcher.wait.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            new_paths = self.poll()
+            if new_paths:
+                return new_paths
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return []
+            time.sleep(delay)
+
+
+def open_watcher(roots, prune=None, interval=1.0):
+    """Return an InotifyWatcher or, if not available, a PollingWatcher."""
+    try:
+        return InotifyWatcher(roots, prune)
+    except OSError as error:
+        logging.info('Polling every {0} s: {1}'.format(interval, error))
+        return PollingWatcher(roots, prune, interval)
+
+
 if __name__ == '__main__':
     pass
@@ -20,12 +20,25 @@ import os
 import shutil
 import time
 import collections
+import math
 import re
+import errno
+import struct
+import locale
+import mmap
+import concurrent.futures
+import io
+import json
+import array
+import hashlib
 
 from batch_renamer import (
-    primitive_name, add_trailing_number,
+    primitive_name,
     filter_out_paths_to_be_renamed,
-    directory_generation_starting_from_files)
+    directory_generation_starting_from_files, ExcludeMatcher,
+    DEFAULT_NAME_CACHE_SIZE, set_name_cache_size, name_cache_info,
+    rename_no_replace, MTIME_RESOLUTION_NS, open_watcher,
+    prefix_iso_mod_dates, run_stats)
 
 
 # # pylama:skip=1
@@ -46,129 +59,1081 @@ def load_exclude_pattern_file(cli_args):
         cli_args.excludepatternfile))
     logging.info('Excluding the following patterns:\n\t{0}'.format(
         '\n\t'.join(excluded_patterns)))
-    if excluded_patterns:
-        list_of_excl_regex_patterns = list(map(
-            re.compile, excluded_patterns))
-    else:
-        list_of_excl_regex_patterns = list()
+    # All the patterns are compiled into a single matcher.
+    return ExcludeMatcher(excluded_patterns)
+
+
+def deduplicate_names(names, suffix='_', exists=None):
+    """Add a trailing number to the names which appear more than once.
+
+    Each group of equal names gets its own counter, starting at 0, and its
+    own zero padding width (eg: a group of 12 names is numbered from '_00'
+    to '_11'). Numbers leading to a name already present in names are
+    skipped. Unique names are left untouched unless they already exist.
+
+    Arguments:
+        names (list): names to be deduplicated.
+        suffix (str): separator between a name and its number.
+        exists (callable): returns True for names which are already taken
+            (eg: by files on disk). Such names are numbered as well.
+
+    Returns:
+        list: deduplicated names in the order of names.
+
+    """
+    if exists is None:
+        def exists(name):
+            return False
+    group_sizes = collections.Counter(names)
+    taken_names = set(group_sizes)
+    # Next number to be tried for each group.
+    counters = dict()
+    deduplicated_names = []
+    for name in names:
+        group_size = group_sizes[name]
+        if group_size == 1 and not exists(name):
+            deduplicated_names.append(name)
+            continue
+        decimal_places = math.ceil(math.log(group_size, 10))
+        number = counters.get(name, 0)
+        new_name = name + suffix + '{0:0{1}d}'.format(number, decimal_places)
+        while new_name in taken_names or exists(new_name):
+            number += 1
+            new_name = name + suffix + '{0:0{1}d}'.format(number,
+                                                          decimal_places)
+        counters[name] = number + 1
+        taken_names.add(new_name)
+        deduplicated_names.append(new_name)
+    return deduplicated_names
+
+
+def primitive_names(old_names):
+    """Return the primitive name of each path in old_names."""
+    with run_stats.phase('naming'):
+        run_stats.count('names', len(old_names))
+        return list(primitive_name(x) for x in old_names)
+
+
+def resolve_names(old_names, new_names, existing_names=None, exists=None):
+    """Make the new names of a batch safe to be renamed to.
+
+    Renamings to the same name are dropped and the remaining new names are
+    deduplicated among themselves and against the existing names.
+
+    Arguments:
+        old_names (list): paths to be renamed.
+        new_names (list): new path of each of old_names.
+        existing_names (dict): names (set) in each directory (str) of
+            old_names. Names of directories missing from it are not checked.
+            The sets are updated with the planned renamings so they stay
+            valid for the following batches.
+        exists (callable): tells whether a path is taken, instead of
+            existing_names (eg: os.path.lexists).
+
+    Returns:
+        tuple: lists of old names and of their deduplicated new names.
+
+    """
+    if existing_names is None:
+        existing_names = dict()
+
+    if exists is None:
+        def exists(name):
+            return (os.path.basename(name)
+                    in existing_names.get(os.path.dirname(name), ()))
+
+    start = time.perf_counter()
+    renamings = [x for x in zip(old_names, new_names) if x[0] != x[1]]
+    run_stats.count('unchanged', len(old_names) - len(renamings))
+    old_names = [x[0] for x in renamings]
+    new_names = deduplicate_names([x[1] for x in renamings], exists=exists)
+    run_stats.count('deduplicated', sum(
+        x[1] != y for x, y in zip(renamings, new_names)))
+    for old_name, new_name in zip(old_names, new_names):
+        dirname = os.path.dirname(old_name)
+        if dirname in existing_names:
+            existing_names[dirname].discard(os.path.basename(old_name))
+            existing_names[dirname].add(os.path.basename(new_name))
+    run_stats.add_time('dedup', time.perf_counter() - start)
+    return old_names, new_names
+
+
+def _prefix_new_names(new_names, entries=None):
+    if entries is None:
+        return new_names
+    return prefix_iso_mod_dates(entries, new_names)
+
+
+def plan_names(old_names, existing_names=None, entries=None):
+    """Return the old names and the deduplicated primitive names of a batch.
+
+    See resolve_names for existing_names. If entries (the PathEntry of each
+    of old_names) are given the new names of files are prefixed with their
+    modification date.
+
+    """
+    return resolve_names(
+        old_names,
+        _prefix_new_names(primitive_names(old_names), entries),
+        existing_names)
+
+
+# Number of names sent at once to the processes of plan_names_in_parallel.
+PLAN_CHUNK_SIZE = 1024
+
+
+def _primitive_names_of_batches(batches_of_old_names):
+    # The hits, misses and new entries of the name cache of the pool process
+    # are returned with the names: they cannot be seen from the parent.
+    before = name_cache_info()
+    batches_of_new_names = [primitive_names(x) for x in batches_of_old_names]
+    after = name_cache_info()
+    return batches_of_new_names, (after.hits - before.hits,
+                                  after.misses - before.misses,
+                                  after.currsize - before.currsize)
+
+
+def plan_names_in_parallel(batches, workers, name_cache_size):
+    """Compute plan_names for every batch using a pool of processes.
+
+    The primitive names are computed by the pool: batches are read as the
+    pool needs them and sent to it in chunks of about PLAN_CHUNK_SIZE names,
+    with at most two chunks per process in flight. The plans are yielded in
+    the order of batches, so the plan is the same as the serial one and only
+    the batches in flight are held in memory.
+
+    Arguments:
+        batches (iterable): tuples of the arguments of plan_names.
+
+    Returns:
+        generator: (old_names, new_names) tuples.
+
+    """
+    batches = iter(batches)
+    # Chunks of batches and the future of their primitive names, in order.
+    pending = collections.deque()
+
+    def submit_chunk():
+        chunk = []
+        n_names = 0
+        for batch in batches:
+            chunk.append(batch)
+            n_names += len(batch[0])
+            if n_names >= PLAN_CHUNK_SIZE:
+                break
+        if chunk:
+            pending.append((chunk, executor.submit(
+                _primitive_names_of_batches, [x[0] for x in chunk])))
+        return bool(chunk)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_name_cache_size,
+            initargs=(name_cache_size, )) as executor:
+        while len(pending) < 2 * workers and submit_chunk():
+            pass
+        while pending:
+            chunk, future = pending.popleft()
+            # The statistics of the pool processes are lost: the naming
+            # phase is accounted here, as the time waiting for the pool.
+            start = time.perf_counter()
+            batches_of_new_names, cache_counts = future.result()
+            run_stats.add_time('naming', time.perf_counter() - start)
+            run_stats.count('names', sum(len(x[0]) for x in chunk))
+            for counter, n in zip(('hits', 'misses', 'size'), cache_counts):
+                run_stats.count('name_cache_pool_' + counter, n)
+            submit_chunk()
+            # The existing names and the entries are only needed here, so
+            # they do not go through the pool.
+            for batch, new_names in zip(chunk, batches_of_new_names):
+                yield resolve_names(batch[0],
+                                    _prefix_new_names(new_names, *batch[2:]),
+                                    batch[1])
+
+
+def get_existing_names(entries, listings):
+    """Return the names found in the directory of each of entries.
+
+    The listings made by the walk are used; the directories of paths given
+    by the user are listed here once and kept in listings (dict).
+
+    Returns:
+        dict: set of names in each directory.
+
+    """
+    existing_names = dict()
+    for one_entry in entries:
+        dirname = os.path.dirname(one_entry.path)
+        if dirname in existing_names:
+            continue
+        if one_entry.siblings is not None:
+            existing_names[dirname] = one_entry.siblings
+        else:
+            if dirname not in listings:
+                listings[dirname] = set(os.listdir(dirname or '.'))
+            existing_names[dirname] = listings[dirname]
+    return existing_names
+
+
+class CompactPlan(object):
+    """Renaming plan stored as a table of directories and basenames.
+
+    A full path per renaming repeats the path of its directory, which is
+    most of its size in deep trees. Here every directory is stored once in
+    a table and each renaming is kept as the ids of the directories of its
+    old and new paths (arrays of integers) and their basenames. The full
+    paths are only built when iterating over the plan, batch by batch, so
+    they live just as long as the renamings of one batch.
+
+    It can be used like a list of (old_names, new_names) tuples.
+
+    Attributes:
+        directories (list): the directory of each id.
+
+    """
+
+    __slots__ = ('directories', '_directory_ids', '_old_directories',
+                 '_old_basenames', '_new_directories', '_new_basenames',
+                 '_batch_ends')
+
+    def __init__(self, plan=()):
+        self.directories = []
+        self._directory_ids = dict()
+        self._old_directories = array.array('I')
+        self._old_basenames = []
+        self._new_directories = array.array('I')
+        self._new_basenames = []
+        self._batch_ends = array.array('L')
+        for old_names, new_names in plan:
+            self.append(old_names, new_names)
+
+    def _directory_id(self, directory):
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = len(self.directories)
+            self._directory_ids[directory] = directory_id
+            self.directories.append(directory)
+        return directory_id
+
+    def append(self, old_names, new_names):
+        """Add a batch of renamings at the end of the plan."""
+        self.append_renamings(zip(old_names, new_names))
+
+    def append_renamings(self, renamings):
+        """Add a batch from an iterable of (src, dst) renamings.
+
+        Empty batches are not added.
+
+        """
+        for src, dst in renamings:
+            directory, basename = os.path.split(src)
+            self._old_directories.append(self._directory_id(directory))
+            self._old_basenames.append(basename)
+            directory, basename = os.path.split(dst)
+            self._new_directories.append(self._directory_id(directory))
+            self._new_basenames.append(basename)
+        start = self._batch_ends[-1] if self._batch_ends else 0
+        if len(self._old_basenames) > start:
+            self._batch_ends.append(len(self._old_basenames))
+
+    def __len__(self):
+        return len(self._batch_ends)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position):
+        """Return the (old_names, new_names) of a batch, as full paths."""
+        start, end = self._batch_range(position)
+        return (self._paths(self._old_directories, self._old_basenames,
+                            start, end),
+                self._paths(self._new_directories, self._new_basenames,
+                            start, end))
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                x[0] == list(y[0]) and x[1] == list(y[1])
+                for x, y in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def _batch_range(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('plan index out of range')
+        start = self._batch_ends[position - 1] if position else 0
+        return start, self._batch_ends[position]
+
+    def _paths(self, directory_ids, basenames, start, end):
+        directories = self.directories
+        return [os.path.join(directories[x], y) for x, y in zip(
+            directory_ids[start:end], basenames[start:end])]
+
+    def records(self):
+        """Yield the renamings of each batch without building full paths.
+
+        Yields:
+            list: (old_directory_id, old_basename, new_directory_id,
+            new_basename) tuples of a batch.
+
+        """
+        for position in range(len(self)):
+            start, end = self._batch_range(position)
+            yield list(zip(self._old_directories[start:end],
+                           self._old_basenames[start:end],
+                           self._new_directories[start:end],
+                           self._new_basenames[start:end]))
+
+
+def _plan_records(plan):
+    """Return the records of plan and a function giving their directories.
+
+    See CompactPlan.records. The directories of a plan given as a list are
+    identified by their path.
+
+    """
+    if isinstance(plan, CompactPlan):
+        return plan.records(), plan.directories.__getitem__
+    records = ([os.path.split(src) + os.path.split(dst)
+                for src, dst in zip(old_names, new_names)]
+               for old_names, new_names in plan)
+    return records, str
+
+
+def validate_plan(plan, exists=None):
+    """Check a whole renaming plan before any of it is executed.
+
+    The renamings are replayed in order over sets of the paths renamed and
+    created so far, so every conflict is found in one pass without touching
+    the disk:
+
+    - a path renamed twice,
+    - two renamings to the same target,
+    - a target that is renamed later on, so it still exists when renaming
+      to it (this includes cycles),
+    - a target that already exists, according to exists.
+
+    Arguments:
+        plan (list or CompactPlan): (old_names, new_names) tuples, in
+            execution order.
+        exists (callable): tells whether a path exists before renaming. The
+            existing files are not checked if it is None, e.g. when the new
+            names were already checked against the directory listings.
 
-    return list_of_excl_regex_patterns
+    Raises:
+        ValueError: listing every conflict found.
 
+    """
+    start = time.perf_counter()
+    conflicts = []
+    # The paths are kept as the basenames in each directory, so a
+    # CompactPlan is checked without building its full paths.
+    sources = collections.defaultdict(set)
+    records, directory_path = _plan_records(plan)
+    for batch in records:
+        for src_dir, src_name, _, _ in batch:
+            if src_name in sources[src_dir]:
+                conflicts.append('renamed twice {0}'.format(
+                    os.path.join(directory_path(src_dir), src_name)))
+            sources[src_dir].add(src_name)
+
+    renamed = collections.defaultdict(set)
+    created = collections.defaultdict(set)
+    records, directory_path = _plan_records(plan)
+    for batch in records:
+        for src_dir, src_name, dst_dir, dst_name in batch:
+            dst_renamed = dst_name in renamed.get(dst_dir, ())
+            conflict = None
+            if dst_name in created.get(dst_dir, ()):
+                conflict = 'duplicate target'
+            elif dst_name in sources.get(dst_dir, ()) and not dst_renamed:
+                conflict = 'target renamed afterwards'
+            elif (not dst_renamed and exists is not None and exists(
+                    os.path.join(directory_path(dst_dir), dst_name))):
+                conflict = 'target exists'
+            if conflict:
+                conflicts.append('{0} {1} -> {2}'.format(
+                    conflict,
+                    os.path.join(directory_path(src_dir), src_name),
+                    os.path.join(directory_path(dst_dir), dst_name)))
+            renamed[src_dir].add(src_name)
+            created[src_dir].discard(src_name)
+            created[dst_dir].add(dst_name)
+    run_stats.add_time('validate', time.perf_counter() - start)
+    if conflicts:
+        raise ValueError('Invalid renaming plan:\n\t{0}'.format(
+            '\n\t'.join(conflicts)))
+
+
+def _rename(src, dst, dir_fds):
+    """Rename src to dst without overwriting it.
+
+    Renames inside a directory are done relative to a file descriptor of
+    that directory (kept in the dir_fds dictionary, None if it cannot be
+    opened) to save resolving its path on every call.
 
-def deduplicate_names(names):
-    # TODO: cover the case when the basenamed file already exists.
-    # In this case an extra duplicated index should be appended then removed to
-    # prevent overwritting of the file that already exists.
+    """
+    parent = os.path.dirname(src)
+    if os.path.dirname(dst) == parent and os.rename in os.supports_dir_fd:
+        if parent not in dir_fds:
+            # Only the directory being renamed is kept open.
+            _close_dir_fds(dir_fds)
+            try:
+                # O_PATH only needs search permission on the directory,
+                # like renaming by path.
+                dir_fds[parent] = os.open(
+                    parent, getattr(os, 'O_PATH', os.O_RDONLY)
+                    | getattr(os, 'O_DIRECTORY', 0))
+            except PermissionError:
+                dir_fds[parent] = None
+        if dir_fds[parent] is not None:
+            rename_no_replace(os.path.basename(src), os.path.basename(dst),
+                              dir_fd=dir_fds[parent])
+            return None
+    try:
+        rename_no_replace(src, dst)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        # Across filesystems: fall back to copying.
+        if os.path.exists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST),
+                                  src, None, dst)
+        shutil.move(src, dst)
+    return None
 
-    # Solve the duplicate names problem by first creating a default dict whose
-    # keys (primitive names) point to the number of indexes. By filtering ones
-    # with more than one index one can find out the duplicate names.
-    duplicate_names = collections.defaultdict(list)
-    for index, item in enumerate(names):
-        duplicate_names[item].append(index)
-    duplicate_names = {k: v for k, v in duplicate_names.items() if len(v) > 1}
 
-    if duplicate_names:
-        # List is modified inplace: add the trailing number.
-        # TODO: XXX urgent need to have more than one batch of duplicate_names
-        # in a single run. The for below must be a two level nested for.
-        for duplicate_indexes in duplicate_names.values():
-            # TODO: error here, is not modified inplace anymore.
-            names = add_trailing_number(names, n=len(duplicate_indexes))
-    return names
+def _close_dir_fds(dir_fds):
+    """Close and forget the directory file descriptors opened by _rename."""
+    for fd in dir_fds.values():
+        if fd is not None:
+            os.close(fd)
+    dir_fds.clear()
 
 
-def execute_renaming(old_names, new_names, args):
-        # TODO: improve the security of this function. All of the new_names
-        # shall be unique.
-        # All of the new names shall not yet exist.
+def execute_renaming(old_names, new_names, history_writer):
+    # The whole plan shall have been checked with validate_plan.
 
-        list_of_file_renamings = []
+    n_renamed = 0
+    history_time = 0.0
+    dir_fds = dict()
+    start = time.perf_counter()
+    try:
         for src, dst in zip(old_names, new_names):
-            if os.path.exists(dst):
+            # The new names shall not yet exist: this is checked atomically
+            # when renaming.
+            rename_start = time.perf_counter()
+            try:
+                _rename(src, dst, dir_fds)
+            except FileExistsError:
+                run_stats.count('failed')
                 raise FileExistsError(
                     'WARNING: WILL NOT OVERWRITE FILE {0} -> {1}'.format(
                         src, dst))
-            try:
-                shutil.move(src, dst)
             except PermissionError:
+                run_stats.count('failed')
                 logging.warning(
                     'PermissionError exception: \'{}\''.format(src))
             except FileNotFoundError:
+                run_stats.count('failed')
                 logging.warning(
                     'FileNotFound exception: \'{}\''.format(src))
             else:
-                # Store the file names with quotes escaped.
-                list_of_file_renamings.append((
+                history_start = time.perf_counter()
+                run_stats.observe('rename', history_start - rename_start)
+                n_renamed += 1
+                # Each renaming is recorded as soon as it is done, in
+                # execution order and with quotes escaped: an entry is
+                # reverted reading it backwards.
+                history_writer.write_record('mv "{0}" "{1}"'.format(
                     dst.replace("\"", "\\\""),
                     src.replace("\"", "\\\"")))
+                history_time += time.perf_counter() - history_start
                 logging.info("mv \"{1}\" \"{0}\"".format(dst, src))
-        # Revert tuple to preserve renaming order (start with
-        # subfolder).
-        list_of_file_renamings = reversed(list_of_file_renamings)
-        list_of_file_renamings = (
-            'mv "{0}" "{1}"'.format(
-                x[0],
-                x[1]) for x in list_of_file_renamings)
-
-        with open(args.historyfile, 'at') as history_file:
-            history_file.write('\n'.join(list_of_file_renamings))
-            history_file.write('\n')
+    finally:
+        _close_dir_fds(dir_fds)
+        run_stats.count('renamed', n_renamed)
+        run_stats.add_time(
+            'rename', time.perf_counter() - start - history_time)
+        history_start = time.perf_counter()
+        history_writer.end_batch()
+        run_stats.add_time(
+            'history', history_time + time.perf_counter() - history_start)
 
 
 # History file related section.
+HEADER_START = '## NEW ENTRY: '
+# Headers of the entries whose renamings are recorded in execution order end
+# with this mark. Older entries have the renamings of each batch reversed.
+HEADER_EXECUTION_ORDER = ' |in execution order|'
+# The history file index is kept next to it with this suffix.
+HISTORY_INDEX_SUFFIX = '.idx'
+
+
+class HistoryIndex(object):
+    """Sidecar index of the entries of a history file.
+
+    The index starts with the number of lines and the size in bytes of the
+    history file it describes, followed by one fixed size record per entry:
+    its id (the number of lines before its header) and the byte offset of its
+    header. Finding the last entry or appending one takes constant time and
+    finding an entry by id a binary search, without reading the history file.
+
+    If the index is missing or does not describe the current history file
+    (eg: it was edited by hand) it is rebuilt with a single scan.
+
+    Arguments:
+        historyfile (str): path of the history file.
+        read_only (bool): do not create nor rebuild the index file. A
+            missing or outdated index is rebuilt in memory.
+
+    Raises:
+        FileNotFoundError: if the history file does not exist.
+
+    """
+
+    _COUNTS = struct.Struct('<QQ')
+    _RECORD = struct.Struct('<QQ')
+
+    def __init__(self, historyfile, read_only=False):
+        self.historyfile = historyfile
+        self.path = historyfile + HISTORY_INDEX_SUFFIX
+        # No index is left behind for a missing history file.
+        history_size = os.path.getsize(historyfile)
+        try:
+            self._file = open(self.path, 'rb' if read_only else 'r+b')
+        except FileNotFoundError:
+            self._file = io.BytesIO() if read_only else open(self.path,
+                                                             'w+b')
+        try:
+            self.n_lines, self.n_bytes = self._COUNTS.unpack(
+                self._file.read(self._COUNTS.size))
+        except struct.error:
+            self.n_lines = self.n_bytes = None
+        if (self.n_bytes != history_size
+                or (self._size() - self._COUNTS.size) % self._RECORD.size):
+            if read_only:
+                self._file.close()
+                self._file = io.BytesIO()
+            self.rebuild()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _size(self):
+        return self._file.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return (self._size() - self._COUNTS.size) // self._RECORD.size
+
+    def rebuild(self):
+        """Rebuild the index scanning the history file once."""
+        logging.info('Indexing history file {0}.'.format(self.historyfile))
+        header_start = HEADER_START.encode()
+        records = []
+        n_lines = n_bytes = 0
+        with open(self.historyfile, 'rb') as history_file:
+            for line in history_file:
+                if line.startswith(header_start):
+                    records.append(self._RECORD.pack(n_lines, n_bytes))
+                n_lines += 1
+                n_bytes += len(line)
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(self._COUNTS.pack(n_lines, n_bytes))
+        self._file.write(b''.join(records))
+        self._file.flush()
+        self.n_lines, self.n_bytes = n_lines, n_bytes
+
+    def entry(self, position):
+        """Return the (id, byte offset) of the entry at position.
+
+        Negative positions count from the last entry like list indexes.
+
+        """
+        n_entries = len(self)
+        if position < 0:
+            position += n_entries
+        if not 0 <= position < n_entries:
+            raise IndexError('History file has no entry {0}.'.format(
+                position))
+        self._file.seek(self._COUNTS.size + position * self._RECORD.size)
+        return self._RECORD.unpack(self._file.read(self._RECORD.size))
+
+    def find(self, entry_id):
+        """Return the position of the entry whose id is entry_id."""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < entry_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self) or self.entry(low)[0] != entry_id:
+            raise ValueError('History file has no entry with id {0}.'.format(
+                entry_id))
+        return low
+
+    def entry_range(self, position):
+        """Return the byte offsets where the entry at position starts and ends.
+
+        The end is None for the last entry, which runs up to the end of the
+        history file.
+
+        """
+        start = self.entry(position)[1]
+        if position in (-1, len(self) - 1):
+            return (start, None)
+        return (start, self.entry(position + 1)[1])
+
+    def append_entry(self, entry_id, offset):
+        """Add the header of a new entry at the end of the index."""
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(self._RECORD.pack(entry_id, offset))
+        self._file.flush()
+
+    def set_counts(self, n_lines, n_bytes):
+        """Record the number of lines and bytes of the history file."""
+        self._file.seek(0)
+        self._file.write(self._COUNTS.pack(n_lines, n_bytes))
+        self._file.flush()
+        self.n_lines, self.n_bytes = n_lines, n_bytes
+
+
+class HistoryWriter(object):
+    """Append to a history file through a single buffered file object.
+
+    The history file is kept open for the whole run and its index (see
+    HistoryIndex) is updated whenever the writes are flushed.
+
+    Arguments:
+        historyfile (str): path of the history file.
+        sync (str or int): durability policy. 'none' leaves flushing to the
+            buffer and the operating system, 'batch' flushes and fsyncs
+            after each batch of renamings and an int N does so every N
+            renamings. The file is always flushed and synced when closed.
+
+    """
+
+    def __init__(self, historyfile, sync='none'):
+        self.sync = sync
+        # The history file is created if needed, before its index.
+        self._file = open(historyfile, 'ab')
+        try:
+            self.index = HistoryIndex(historyfile)
+        except OSError:
+            self._file.close()
+            raise
+        # The text is encoded here (as open would do) to know the byte
+        # offsets of the entries without flushing.
+        self._encoding = locale.getpreferredencoding(False)
+        self._n_lines = self.index.n_lines
+        self._n_bytes = self.index.n_bytes
+        self._unsynced_records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, text):
+        data = text.encode(self._encoding)
+        self._file.write(data)
+        self._n_lines += text.count('\n')
+        self._n_bytes += len(data)
+
+    def write_header(self):
+        """Start a new entry. Its id is the number of lines before it."""
+        change_number = self._n_lines
+        self.index.append_entry(change_number, self._n_bytes)
+        self._write(
+            HEADER_START
+            + '|' + str(change_number) + '|'
+            + 'at time ' + time.ctime()
+            + HEADER_EXECUTION_ORDER + '\n')
+        # The header is made durable under the same policy as the records
+        # that follow it.
+        if self.sync != 'none':
+            self.flush(fsync=True)
+        return change_number
+
+    def write_record(self, line):
+        """Write one line to the current entry.
+
+        With an int N as sync policy, the writes are flushed and synced
+        once N records are pending.
+
+        """
+        self._write(line + '\n')
+        self._unsynced_records += 1
+        if (isinstance(self.sync, int)
+                and self._unsynced_records >= self.sync):
+            self.flush(fsync=True)
+
+    def end_batch(self):
+        """Flush and sync the pending records with the 'batch' policy."""
+        if self.sync == 'batch' and self._unsynced_records:
+            self.flush(fsync=True)
+
+    def write_batch(self, lines):
+        """Write lines to the current entry applying the sync policy."""
+        for line in lines:
+            self.write_record(line)
+        self.end_batch()
+
+    def flush(self, fsync=False):
+        """Flush the writes (and fsync them) then update the index."""
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+            self._unsynced_records = 0
+        self.index.set_counts(self._n_lines, self._n_bytes)
+
+    def close(self):
+        if self._file.closed:
+            return None
+        try:
+            self.flush(fsync=True)
+        finally:
+            self._file.close()
+            self.index.close()
+
+
+def history_sync_policy(value):
+    """Parse the --history-sync argument: 'none', 'batch' or a number."""
+    if value in ('none', 'batch'):
+        return value
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "expected 'none', 'batch' or a positive number of renamings")
+    return value
+
+
+def append_to_historyfile(historyfile, text):
+    """Append lines of text to the history file."""
+    with HistoryWriter(historyfile) as history_writer:
+        history_writer.write_batch(text.splitlines())
+
+
 def get_last_id_from_change_in_historyfile(historyfile):
-    HEADER_START = '## NEW ENTRY: '
-    with open(historyfile, 'rt') as f:
-        for i, line in enumerate(f, 1):
-            if line.startswith(HEADER_START):
-                change_number = i
+    with HistoryIndex(historyfile, read_only=True) as index:
+        # The id is the number of lines before the header: return the line
+        # number of the header.
+        change_number = index.entry(-1)[0] + 1
     return change_number
 
 
 def write_header_to_historyfile(historyfile):
-    HEADER_START = '## NEW ENTRY: '
-    with open(historyfile, 'rt') as history_file:
-        change_number = len(history_file.read().splitlines())
-    header = (
-        HEADER_START
-        + '|' + str(change_number) + '|'
-        + 'at time ' + time.ctime()
-        + '\n')
-    with open(historyfile, 'at') as history_file:
-        history_file.write(header)
+    with HistoryWriter(historyfile) as history_writer:
+        history_writer.write_header()
 
 
-def get_range_from_history_file(args):
-    if args.revert == 'last':
-        start_change_number = get_last_id_from_change_in_historyfile(
-            args.historyfile)
-        end_change_number = None
+def get_entry_range(index, entry_id='last'):
+    """Return the range of bytes of an entry of a history file.
+
+    Arguments:
+        index (HistoryIndex): index of the history file.
+        entry_id (str or int): id of the header of the entry or 'last'.
+
+    """
+    if entry_id == 'last':
+        position = -1
     else:
-        start_change_number = args.revert
-        with open(args.historyfile, 'rt') as f:
-            for i, line in enumerate(
-                    f.read().splitlines()[start_change_number:],
-                    1):
-                if line.startswith(HEADER_START):
-                    end_change_number = (start_change_number
-                                         + i
-                                         + 1)  # include this line as well.
-    return (start_change_number, end_change_number)
+        position = index.find(int(entry_id))
+    return index.entry_range(position)
+
+
+def get_range_from_history_file(args):
+    """Return the range of bytes of the entry to be reverted.
 
+    The entry is the last one if args.revert is 'last' or the one whose
+    header has the id args.revert otherwise.
+
+    """
+    with HistoryIndex(args.historyfile, read_only=True) as index:
+        return get_entry_range(index, args.revert)
+
+
+def read_lines_from_historyfile(historyfile, start, end=None,
+                                reverse=False):
+    """Yield the lines of the history file between two byte offsets.
+
+    The file is memory mapped and the lines are decoded one at a time, so
+    reading an entry needs memory proportional to a line, not to the file.
+    If reverse is True the lines are yielded from the last one.
+
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(historyfile, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            end = size if end is None else min(end, size)
+            if end <= start:
+                return None
+            if not reverse:
+                position = start
+                while position < end:
+                    line_end = mapped.find(b'\n', position, end)
+                    if line_end == -1:
+                        line_end = end
+                    yield mapped[position:line_end].decode(encoding)
+                    position = line_end + 1
+                return None
+            # The newline ending the last line does not start another one.
+            position = end
+            if mapped[position - 1] == ord('\n'):
+                position -= 1
+            while True:
+                line_start = mapped.rfind(b'\n', start, position) + 1
+                line_start = max(line_start, start)
+                yield mapped[line_start:position].decode(encoding)
+                if line_start == start:
+                    break
+                position = line_start - 1
+    return None
 
 
 def get_rename_changes_from_historyfile(historyfile, change_range):
+    """Return the renamings which revert an entry of the history file.
+
+    Arguments:
+        historyfile (str): path of the history file.
+        change_range (tuple): byte offsets of the entry (see
+            get_range_from_history_file).
+
+    Returns:
+        list: (current path, original path) tuples in the reverse order of
+            the renamings of the entry.
+
+    """
+    header = next(read_lines_from_historyfile(historyfile, *change_range),
+                  '')
+    in_execution_order = header.endswith(HEADER_EXECUTION_ORDER)
     mv_regex = re.compile(r'^mv "(.+?)(?<!\\)" "(.+?)(?<!\\)"$')
-    with open(historyfile, 'rt') as f:
-        regex_map = map(
-            mv_regex.search,
-            f.read().splitlines()[change_range[0]:change_range[1]])
-        inverted_regex_map = map(
-            lambda x: (x.group(1), x.group(2)),
-            regex_map)
-    return inverted_regex_map
+    regex_map = filter(
+        None,
+        map(mv_regex.search,
+            read_lines_from_historyfile(historyfile, *change_range,
+                                        reverse=in_execution_order)))
+    inverted_regex_map = map(
+        lambda x: (x.group(1).replace('\\"', '"'),
+                   x.group(2).replace('\\"', '"')),
+        regex_map)
+    if in_execution_order:
+        return list(inverted_regex_map)
+    # Older entries only record bottom-up renamings, whose paths refer to
+    # the original names of their parent directories: restoring the
+    # shallowest paths first makes them valid.
+    return sorted(inverted_regex_map, key=lambda x: x[0].count(os.sep))
+
+
+# Plan file related section.
+def write_plan_file(planfile, plan):
+    """Write a plan as JSON lines with the 'src' and 'dst' of each renaming.
+
+    Arguments:
+        planfile (str): path of the plan file.
+        plan (iterable): (old_names, new_names) tuples.
+
+    Returns:
+        int: the number of renamings written.
+
+    """
+    n_renamings = 0
+    with open(planfile, 'wt') as plan_file:
+        for old_names, new_names in plan:
+            for src, dst in zip(old_names, new_names):
+                plan_file.write(json.dumps({'src': src, 'dst': dst}) + '\n')
+                n_renamings += 1
+    return n_renamings
+
+
+def read_plan_file(planfile):
+    """Return a generator of the (src, dst) renamings of a plan file."""
+    with open(planfile, 'rt') as plan_file:
+        for line_number, line in enumerate(plan_file, 1):
+            if not line.strip():
+                continue
+            try:
+                renaming = json.loads(line)
+                yield renaming['src'], renaming['dst']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('Malformed line {0} of plan file {1}'.format(
+                    line_number, planfile))
+
+
+def print_plan(plan):
+    """Print the renamings of a plan (see write_plan_file) to stdout."""
+    for old_names, new_names in plan:
+        for src, dst in zip(old_names, new_names):
+            print('mv "{0}" "{1}"'.format(src, dst))
+
+
+# State file related section.
+def state_fingerprint(exclude_matcher, compiled_regex_to_trigger_renaming):
+    """Return a digest of the settings that tell which names are compliant.
+
+    A state file recorded with different settings is not used.
+
+    """
+    settings = [compiled_regex_to_trigger_renaming.pattern]
+    settings.extend(x.pattern for x in exclude_matcher.patterns)
+    return hashlib.sha1(json.dumps(settings).encode('utf8')).hexdigest()
+
+
+class StateIndex(object):
+    """Directories whose whole subtree was compliant on previous runs.
+
+    Each directory is recorded with its device, inode and modification time,
+    and only if its own name, its files and every subdirectory recorded are
+    compliant. Adding, removing or renaming an entry changes the
+    modification time of its directory, so a recorded directory whose
+    subdirectories (recursively) all still match their records has nothing
+    to rename and is not walked: it costs one stat per directory instead of
+    listing and renaming every entry.
 
+    The state file is rewritten at the end of each run with the directories
+    found compliant or skipped during it.
+
+    Arguments:
+        statefile (str): path of the JSON state file.
+        fingerprint (str): see state_fingerprint.
+
+    """
+
+    def __init__(self, statefile, fingerprint):
+        self.statefile = statefile
+        self.fingerprint = fingerprint
+        self._started = time.time_ns()
+        self._previous = dict()
+        try:
+            with open(statefile, 'rt') as state:
+                content = json.load(state)
+            if content['fingerprint'] == fingerprint:
+                self._previous = content['directories']
+            else:
+                logging.info('Settings changed, not using the state file.')
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Ignoring malformed state file \'{0}\'.'.format(
+                statefile))
+        self._children = collections.defaultdict(list)
+        for path in self._previous:
+            self._children[os.path.dirname(path)].append(path)
+        # Whether the recorded subtree of each directory checked is
+        # unchanged.
+        self._unchanged = dict()
+        self._current = dict()
+        self._not_compliant = set()
+
+    def __len__(self):
+        return len(self._current)
+
+    def _matches_record(self, path):
+        record = self._previous.get(path)
+        if record is None:
+            return False
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return False
+        return record == [stat_result.st_dev, stat_result.st_ino,
+                          stat_result.st_mtime_ns]
+
+    def _unchanged_subtree(self, path):
+        """Return whether the recorded subtree of path is unchanged.
+
+        The subtree is checked bottom-up and the result kept for each of its
+        directories, so every recorded directory is checked with one stat
+        even though the walk asks again for the subdirectories of a changed
+        one.
+
+        """
+        stack = [(path, False)]
+        while stack:
+            one_path, children_checked = stack.pop()
+            if one_path in self._unchanged:
+                continue
+            if children_checked:
+                self._unchanged[one_path] = all(
+                    self._unchanged[x] for x in self._children[one_path])
+            elif not self._matches_record(one_path):
+                self._unchanged[one_path] = False
+            else:
+                stack.append((one_path, True))
+                stack.extend((x, False) for x in self._children[one_path])
+        return self._unchanged[path]
+
+    def skip_subtree(self, entry):
+        """Return True if the directory entry is known to be compliant."""
+        path = os.path.abspath(entry.path)
+        if not self._unchanged_subtree(path):
+            return False
+        logging.debug('Not walking unchanged \'{0}\'.'.format(entry.path))
+        run_stats.count('directories_skipped')
+        stack = [path]
+        while stack:
+            one_path = stack.pop()
+            self._current[one_path] = self._previous[one_path]
+            stack.extend(self._children[one_path])
+        return True
+
+    def record(self, directory, compliant):
+        """Record a walked directory (PathEntry) if its subtree is compliant.
+
+        Directories shall be recorded bottom-up, after their subdirectories.
+
+        """
+        path = os.path.abspath(directory.path)
+        try:
+            stat_result = directory.stat()
+        except OSError:
+            compliant = False
+        else:
+            # A later change could leave the modification time unchanged.
+            if (stat_result.st_mtime_ns
+                    > self._started - MTIME_RESOLUTION_NS):
+                compliant = False
+        if compliant and path not in self._not_compliant:
+            self._current[path] = [stat_result.st_dev, stat_result.st_ino,
+                                   stat_result.st_mtime_ns]
+        else:
+            # The parent directory shall not be skipped without walking
+            # this one.
+            self._not_compliant.add(os.path.dirname(path))
+        self._not_compliant.discard(path)
+
+    def walk_error(self, error):
+        """Do not record the parent of a directory that cannot be listed."""
+        logging.warning('Cannot list \'{0}\': {1}'.format(
+            error.filename, error.strerror))
+        self._not_compliant.add(
+            os.path.dirname(os.path.abspath(error.filename)))
+
+    def save(self):
+        """Write the state file (atomically)."""
+        temporary_file = self.statefile + '.tmp'
+        with open(temporary_file, 'wt') as state:
+            json.dump({'fingerprint': self.fingerprint,
+                       'directories': self._current}, state)
+        os.replace(temporary_file, self.statefile)
 
 
 # Test related section.
@@ -204,6 +1169,14 @@ def create_batch_renamer_parser():
         'to allow the user to revert them if needed.',
         required=False)
 
+    parser.add_argument(
+        '--history-sync',
+        help='When to fsync the history file: \'none\' (default, leave it to '
+        'the operating system), \'batch\' (after each directory) or a number '
+        'N (every N renamings).',
+        type=history_sync_policy,
+        default='none')
+
     parser.add_argument(
         '--excludepatternfile',
         help='Do not rename files whose full path is a '
@@ -217,6 +1190,78 @@ def create_batch_renamer_parser():
         action='store_true',
         default=False)
 
+    parser.add_argument(
+        '--name-cache-size',
+        help='Number of distinct basenames whose primitive name is kept in '
+        'memory (default: %(default)s). Use 0 to disable the cache.',
+        type=int,
+        default=DEFAULT_NAME_CACHE_SIZE)
+
+    parser.add_argument(
+        '--walk-workers',
+        help='Number of threads listing directories concurrently '
+        '(default: %(default)s). Values above 1 speed up the walk on network '
+        'filesystems.',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '--plan-workers',
+        help='Number of processes computing the new names '
+        '(default: %(default)s).',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '--state-file',
+        help='Record the directories found compliant in this file and do not '
+        'walk them on later runs while they are unchanged. Not used with '
+        '--prefixisomoddate.',
+        required=False)
+
+    parser.add_argument(
+        '--watch',
+        help='Keep running and rename the files created in or moved into the '
+        'input folders as they arrive. With inotify (Linux) new files are '
+        'renamed once closed after writing.',
+        action='store_true',
+        default=False)
+
+    parser.add_argument(
+        '--watch-delay',
+        help='In watch mode, seconds without new files after which the new '
+        'files are renamed (default: %(default)s). It is also the polling '
+        'interval where inotify is not available.',
+        type=float,
+        default=1.0)
+
+    parser.add_argument(
+        '--plan-out',
+        help='Write the renamings of --input to this file (JSON lines) '
+        'instead of executing them.',
+        required=False)
+
+    parser.add_argument(
+        '--apply-plan',
+        help='Execute the renamings of a file written with --plan-out.',
+        required=False)
+
+    parser.add_argument(
+        '--chunk-size',
+        help='Rename the files of each directory in chunks of at most this '
+        'many entries, keeping memory bounded, instead of planning the whole '
+        'tree first. Each chunk is then validated on its own. Not used with '
+        '--plan-out and --dryrun.',
+        type=int,
+        default=None)
+
+    parser.add_argument(
+        '--stats',
+        help='Write the time spent in each phase, the number of entries '
+        'scanned, excluded, renamed and failed and the latency of the '
+        'renamings to this file (JSON) at exit.',
+        required=False)
+
     parser.add_argument(
         '--dryrun',
         help='Print dummy commands to stdout without actually renaming '
@@ -265,9 +1310,10 @@ def logging_setup(verbose):
         logging.basicConfig(format='%(levelname)s: %(asctime)s: %(message)s',
                             level=logging.INFO, datefmt='%Y/%m/%d %H:%M:%S')
         logging.info('Verbose mode.')
-    if verbose == 2:
-        # TODO: create a debug utility.
-        pass
+    if verbose is not None and verbose >= 2:
+        logging.basicConfig(format='%(levelname)s: %(asctime)s: %(message)s',
+                            level=logging.DEBUG, datefmt='%Y/%m/%d %H:%M:%S')
+        logging.debug('Debug mode.')
     return None
 
 
@@ -276,11 +1322,23 @@ def check_arguments(args):
 
     Do not initalize them.
     """
-    # First check if either (exclusive) or 'input' or 'revert' is specified.
-    if not (bool(args.input) ^ bool(args.revert)):
+    # First check if either (exclusive) 'input', 'revert' or 'apply-plan' is
+    # specified.
+    if sum((bool(args.input), bool(args.revert), bool(args.apply_plan))) != 1:
         raise ValueError(
-            "The '--input' ({0}) and '--revert' ({1}) flags shall not be "
-            "specified togeter".format(args.input, args.revert))
+            "Exactly one of the '--input' ({0}), '--revert' ({1}) and "
+            "'--apply-plan' ({2}) flags shall be specified".format(
+                args.input, args.revert, args.apply_plan))
+    if (args.watch or args.plan_out) and not args.input:
+        raise ValueError(
+            "The '--watch' and '--plan-out' flags only apply to '--input'")
+    if args.watch and args.plan_out:
+        raise ValueError(
+            "The '--watch' and '--plan-out' flags shall not be specified "
+            "together")
+    if args.apply_plan and not os.path.isfile(args.apply_plan):
+        raise FileNotFoundError(
+            'Plan file {0} does not exist'.format(args.apply_plan))
 
     # In both cases history file must be mentioned.
     if not os.path.isfile(args.historyfile):
@@ -330,60 +1388,447 @@ def check_arguments(args):
 
 
 # Main section.
-def rename_files(args):
-    # Constants declaration.
-    RE_COMPILED_NOT_ALLOWED_EXPR = re.compile('[^a-z0-9\_\.]', flags=0)
+# Names with any other character are renamed.
+RE_COMPILED_NOT_ALLOWED_EXPR = re.compile(r'[^a-z0-9\_\.]', flags=0)
+
+
+class Renamer(object):
+    """Plan, apply and revert renamings with a configuration loaded once.
+
+    The exclude patterns are compiled when the renamer is created, so that
+    each call only does the actual work. The history file is opened (and
+    created if needed) the first time it is written and stays open until
+    close is called: planning does not touch it.
+
+    Arguments:
+        historyfile (str): path of the history file.
+        exclude_patterns (ExcludeMatcher): paths not to be renamed. A list
+            of patterns is also accepted.
+        prefixisomoddate (bool): prefix the names of files with their
+            modification date.
+        walk_workers (int): threads listing directories.
+        plan_workers (int): processes computing the new names.
+        name_cache_size (int): see set_name_cache_size. The cache is shared
+            by the whole process: it is only resized (and so emptied) when
+            its size differs.
+        history_sync (str or int): see HistoryWriter.
+        state_file (str): see StateIndex. It is not used with
+            prefixisomoddate nor chunk_size.
+        chunk_size (int): see rename.
+
+    Examples:
+        >>> with Renamer('history.txt', [r'\\.git']) as renamer:
+        ...     entry_id = renamer.apply(renamer.plan(['/data/inbox']))
+        ...     renamer.revert(entry_id)
+
+    """
+
+    def __init__(self, historyfile, exclude_patterns=(),
+                 prefixisomoddate=False, walk_workers=1, plan_workers=1,
+                 name_cache_size=DEFAULT_NAME_CACHE_SIZE, history_sync='none',
+                 state_file=None, chunk_size=None):
+        if not isinstance(exclude_patterns, ExcludeMatcher):
+            exclude_patterns = ExcludeMatcher(exclude_patterns)
+        self.exclude_matcher = exclude_patterns
+        self.historyfile = historyfile
+        self.prefixisomoddate = prefixisomoddate
+        self.walk_workers = walk_workers
+        self.plan_workers = plan_workers
+        self.name_cache_size = name_cache_size
+        if name_cache_info().maxsize != name_cache_size:
+            set_name_cache_size(name_cache_size)
+        # The modification dates of files do not change the modification
+        # time of their directory, so the state file is not used to prefix
+        # them.
+        if state_file and prefixisomoddate:
+            logging.warning(
+                'The state file is not used with --prefixisomoddate.')
+            state_file = None
+        # Chunks of files are not recorded with their directory.
+        if state_file and chunk_size:
+            logging.warning('The state file is not used with --chunk-size.')
+            state_file = None
+        self.state_file = state_file
+        self.chunk_size = chunk_size
+        if state_file:
+            self._state_fingerprint = state_fingerprint(
+                self.exclude_matcher, RE_COMPILED_NOT_ALLOWED_EXPR)
+        # State of the trees of the last plan, saved once it is applied.
+        self._state_index = None
+        self.history_sync = history_sync
+        self._history_writer = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Return a Renamer configured by the command line arguments."""
+        exclude_patterns = ()
+        if args.excludepatternfile:
+            exclude_patterns = load_exclude_pattern_file(args)
+        return cls(args.historyfile, exclude_patterns,
+                   prefixisomoddate=args.prefixisomoddate,
+                   walk_workers=args.walk_workers,
+                   plan_workers=args.plan_workers,
+                   name_cache_size=args.name_cache_size,
+                   history_sync=args.history_sync,
+                   state_file=args.state_file,
+                   chunk_size=args.chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def history_writer(self):
+        """The HistoryWriter of the history file, opened on first use."""
+        if self._history_writer is None:
+            self._history_writer = HistoryWriter(self.historyfile,
+                                                 self.history_sync)
+        return self._history_writer
+
+    def close(self):
+        """Flush and close the history file."""
+        if self._history_writer is not None:
+            self._history_writer.close()
+
+    def _generate_batches_of_entries(self, paths, state_index=None,
+                                     chunk_size=None):
+        """Return the batches of PathEntry of paths to be renamed."""
+        files = list(filter(os.path.isfile, paths))
+        folders = list(filter(os.path.isdir, paths))
+        skip_subtree = walk_error = None
+        if state_index is not None:
+            skip_subtree = state_index.skip_subtree
+            walk_error = state_index.walk_error
+
+        walk = directory_generation_starting_from_files(
+            files,
+            folders,
+            self.exclude_matcher,
+            self.walk_workers,
+            skip_subtree=skip_subtree,
+            onerror=walk_error,
+            chunk_size=chunk_size)
+        # First filtering all the files that need to be renamed with
+        # RE_COMPILED_NOT_ALLOWED_EXPR.
+        # Then we filter the excluded patterns given in excludepatternfile
+        # with exclude_matcher.
+        # Both are accomplisshed in one step.
+        for recurse in run_stats.timed('walk', walk):
+            entries = filter_out_paths_to_be_renamed(
+                recurse,
+                RE_COMPILED_NOT_ALLOWED_EXPR,
+                self.exclude_matcher,
+                self.prefixisomoddate)
+            # Walked directories come last in their batch.
+            if state_index is not None and recurse[-1].is_dir():
+                state_index.record(recurse[-1], not entries)
+            # Batches with nothing to rename are skipped.
+            if entries:
+                yield entries
+
+    def plan(self, paths):
+        """Return the validated plan to rename paths.
+
+        Arguments:
+            paths (list): files and directories to be renamed. Directories
+                are renamed with their whole tree.
+
+        Returns:
+            CompactPlan: (old_names, new_names) tuples (see validate_plan).
+
+        """
+        state_index = None
+        if self.state_file:
+            state_index = StateIndex(self.state_file,
+                                     self._state_fingerprint)
+        batches_of_entries = self._generate_batches_of_entries(
+            paths, state_index)
+        # The new names are checked against the names already in the
+        # directories.
+        listings = dict()
+        batches = (
+            ([x.path for x in entries], get_existing_names(entries, listings),
+             entries if self.prefixisomoddate else None)
+            for entries in batches_of_entries)
+        # The whole plan is computed and validated before renaming anything.
+        # Only its compact form is kept: the full paths of each batch are
+        # dropped once it is planned.
+        if self.plan_workers > 1:
+            plan = CompactPlan(plan_names_in_parallel(
+                batches, self.plan_workers, self.name_cache_size))
+        else:
+            plan = CompactPlan(plan_names(*x) for x in batches)
+        # The new names were checked against the listings while planning.
+        validate_plan(plan)
+        self._state_index = state_index
+        return plan
+
+    def rename(self, paths):
+        """Rename paths as a new entry of the history file.
+
+        Without chunk_size this is apply(plan(paths)). With it the entries
+        are walked, renamed and forgotten chunk by chunk, so memory is
+        bounded by chunk_size instead of by the size of the tree. The new
+        names are then checked against the disk, where the previous chunks
+        are already renamed, and each chunk is validated on its own.
+
+        Arguments:
+            paths (list): see plan.
+
+        Returns:
+            int: the id of the entry in the history file.
+
+        """
+        if not self.chunk_size:
+            return self.apply(self.plan(paths))
+        entry_id = self.history_writer.write_header()
+        for entries in self._generate_batches_of_entries(
+                paths, chunk_size=self.chunk_size):
+            old_names = [x.path for x in entries]
+            new_names = _prefix_new_names(
+                primitive_names(old_names),
+                entries if self.prefixisomoddate else None)
+            chunk_plan = [resolve_names(old_names, new_names,
+                                        exists=os.path.lexists)]
+            validate_plan(chunk_plan)
+            execute_renaming(*chunk_plan[0], self.history_writer)
+        self.history_writer.flush()
+        return entry_id
+
+    def apply(self, plan):
+        """Execute a plan as a new entry of the history file.
+
+        Arguments:
+            plan (list or CompactPlan): (old_names, new_names) tuples,
+                already validated.
+
+        Returns:
+            int: the id of the entry in the history file.
+
+        """
+        entry_id = self.history_writer.write_header()
+        for old_names, new_names in plan:
+            execute_renaming(old_names, new_names, self.history_writer)
+        self.history_writer.flush()
+        if self._state_index is not None:
+            self._state_index.save()
+            logging.info(
+                '{0} compliant directories recorded in the state file.'
+                .format(len(self._state_index)))
+            self._state_index = None
+        return entry_id
+
+    def revert_plan(self, entry_id='last'):
+        """Return the validated plan reverting an entry of the history file.
+
+        Arguments:
+            entry_id (str or int): id of the entry or 'last'.
+
+        """
+        if self._history_writer is not None:
+            self._history_writer.flush()
+            change_range = get_entry_range(self._history_writer.index,
+                                           entry_id)
+        else:
+            with HistoryIndex(self.historyfile, read_only=True) as index:
+                change_range = get_entry_range(index, entry_id)
+        renamings = get_rename_changes_from_historyfile(self.historyfile,
+                                                        change_range)
+        if not renamings:
+            return []
+        plan = [tuple(zip(*renamings))]
+        validate_plan(plan, exists=os.path.lexists)
+        return plan
+
+    def revert(self, entry_id='last'):
+        """Revert an entry of the history file.
+
+        The renamings are recorded as a new entry of the history file, so
+        the revert can be reverted in turn and leaves the other entries as
+        they were.
+
+        Returns:
+            int: the id of the new entry.
+
+        """
+        plan = self.revert_plan(entry_id)
+        if not plan:
+            logging.info('Nothing to revert.')
+        new_entry_id = self.history_writer.write_header()
+        for old_names, new_names in plan:
+            execute_renaming(old_names, new_names, self.history_writer)
+        self.history_writer.flush()
+        return new_entry_id
+
+
+def name_cache_stats():
+    """Return the hits, misses, size and maxsize of the name cache.
+
+    The hits, misses and size include those of the caches of the pool
+    processes of plan_names_in_parallel in this run. The maxsize is the one
+    of each process.
 
+    """
+    cache_info = name_cache_info()
+    counters = run_stats.counters
+    return {'hits': cache_info.hits + counters['name_cache_pool_hits'],
+            'misses': cache_info.misses + counters['name_cache_pool_misses'],
+            'size': cache_info.currsize + counters['name_cache_pool_size'],
+            'maxsize': cache_info.maxsize}
+
+
+def log_name_cache_info():
+    logging.info('Name cache: {hits} hits, {misses} misses '
+                 '({size} of {maxsize} entries).'.format(**name_cache_stats()))
+
+
+def rename_files(args):
     # Setup logging.
     logging_setup(args.verbose)
 
-    # Load list of excluded regex patterns.
-    list_of_excl_regex_patterns = load_exclude_pattern_file(args)
-
-    write_header_to_historyfile(args.historyfile)
-
-    # First filtering all the files that need to be renamed with
-    # RE_COMPILED_NOT_ALLOWED_EXPR.
-    # Then we filter the excluded patterns given in excludepatternfile in
-    # list_of_excl_regex_patterns.
-    # Both are accomplisshed in one step.
-    input_args = dict()
-    input_args['files'] = list(filter(os.path.isfile, args.input))
-    input_args['folders'] = list(filter(os.path.isdir, args.input))
-    for recurse in directory_generation_starting_from_files(
-            input_args['files'],
-            input_args['folders']):
-        paths_to_rename = filter_out_paths_to_be_renamed(
-            recurse,
-            RE_COMPILED_NOT_ALLOWED_EXPR,
-            list_of_excl_regex_patterns,
-            args.prefixisomoddate)
-        new_names = list(primitive_name(x) for x in paths_to_rename)
-
-        # Deduplicate names.
-        new_names = deduplicate_names(new_names)
-
-        execute_renaming(paths_to_rename, new_names, args)
+    with Renamer.from_args(args) as renamer:
+        if args.plan_out:
+            n_renamings = write_plan_file(args.plan_out,
+                                          renamer.plan(args.input))
+            logging.info('{0} renamings written to {1}.'.format(
+                n_renamings, args.plan_out))
+        elif args.dryrun:
+            print_plan(renamer.plan(args.input))
+        else:
+            renamer.rename(args.input)
+
+    log_name_cache_info()
+
+
+def split_new_paths(paths):
+    """Return the files and the directories among the new paths.
+
+    Paths inside one of the new directories are left out: they are renamed
+    with the tree of that directory.
+
+    Returns:
+        tuple: lists of files and of directories.
+
+    """
+    paths = set(filter(os.path.lexists, paths))
+    folders = set(x for x in paths
+                  if os.path.isdir(x) and not os.path.islink(x))
+
+    def in_new_folder(path):
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in folders:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+
+    paths = [x for x in paths if not in_new_folder(x)]
+    return ([x for x in paths if x not in folders],
+            [x for x in paths if x in folders])
+
+
+def watch_files(args):
+    """Rename the paths created in the input folders until interrupted.
+
+    The events of a burst (until none arrives for args.watch_delay seconds)
+    are renamed together, as one entry of the history file.
+
+    """
+    logging_setup(args.verbose)
+    roots = list(filter(os.path.isdir, args.input))
+    if not roots:
+        raise ValueError('Only folders can be watched: {0}'.format(
+            ', '.join(args.input)))
+    # The state file is meant for whole trees.
+    args.state_file = None
+
+    with Renamer.from_args(args) as renamer:
+        def prune(entry):
+            return renamer.exclude_matcher.excludes_subtree(entry.path)
+
+        with open_watcher(roots, prune, args.watch_delay) as watcher:
+            logging.info('Watching {0} directories.'.format(len(watcher)))
+            try:
+                while True:
+                    new_paths = set(watcher.wait())
+                    # Bursts are coalesced, but not for longer than ten
+                    # delays.
+                    deadline = time.monotonic() + 10 * args.watch_delay
+                    while time.monotonic() < deadline:
+                        more_paths = watcher.wait(args.watch_delay)
+                        if not more_paths:
+                            break
+                        new_paths.update(more_paths)
+                    files, folders = split_new_paths(new_paths)
+                    try:
+                        plan = renamer.plan(files + folders)
+                        if plan and args.dryrun:
+                            print_plan(plan)
+                        elif plan:
+                            renamer.apply(plan)
+                    except (OSError, ValueError) as error:
+                        logging.error(error)
+            except KeyboardInterrupt:
+                logging.info('Stopped watching.')
+    log_name_cache_info()
+
 
 def revert_rename_files(args):
-    change_range = get_range_from_history_file(args)
+    with Renamer.from_args(args) as renamer:
+        if args.dryrun:
+            print_plan(renamer.revert_plan(args.revert))
+        else:
+            renamer.revert(args.revert)
+
+
+def apply_plan_file(args):
+    """Execute the renamings of a plan file written with --plan-out."""
+    logging_setup(args.verbose)
 
-    map_of_tuples_to_be_renamed = get_rename_changes_from_historyfile(
-        args.historyfile, change_range)
+    plan = CompactPlan()
+    plan.append_renamings(read_plan_file(args.apply_plan))
+    if not plan:
+        logging.info('Nothing to rename.')
+        return None
+    # The files may have changed since planning: the targets are checked on
+    # disk.
+    validate_plan(plan, exists=os.path.lexists)
+    if args.dryrun:
+        print_plan(plan)
+        return None
 
-    old_names, new_names = zip(*map_of_tuples_to_be_renamed)
+    with Renamer.from_args(args) as renamer:
+        renamer.apply(plan)
+
+
+def write_stats_file(statsfile):
+    """Write the statistics of the run (see RunStats) as JSON."""
+    content = run_stats.as_dict()
+    content['name_cache'] = name_cache_stats()
+    with open(statsfile, 'wt') as stats:
+        json.dump(content, stats, indent=4, sort_keys=True)
 
-    execute_renaming(old_names, new_names, args)
 
 def main(args):
     """Execute the actual renaming of files."""
-
-    # Execute rename of files.
-    if args.input:
-        rename_files(args)
-    # Execute restore of file names.
-    elif args.revert:
-        revert_rename_files(args)
+    run_stats.reset()
+    try:
+        # Execute rename of files.
+        if args.apply_plan:
+            apply_plan_file(args)
+        elif args.input and args.watch:
+            watch_files(args)
+        elif args.input:
+            rename_files(args)
+        # Execute restore of file names.
+        elif args.revert:
+            revert_rename_files(args)
+    finally:
+        # Also for failed runs.
+        if args.stats:
+            write_stats_file(args.stats)
 
 
 if __name__ == '__main__':
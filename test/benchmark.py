@@ -0,0 +1,244 @@
+"""Benchmark the batch_renamer module on synthetic trees.
+
+A random tree is generated with the helpers of the test module and every
+phase of a renaming (walk, filter, naming, deduplication, validation, rename
+and revert) is timed on its own. The results can be saved as a baseline and
+later runs compared against it:
+
+    python benchmark.py --depth 4 --fanout 6 --json baseline.json
+    python benchmark.py --depth 4 --fanout 6 --baseline baseline.json
+
+The comparison fails (exit status 1) if a phase processes less entries per
+second than the baseline by more than the tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import resource
+import tracemalloc
+
+from batch_renamer.batch_renamer import directory_generation_starting_from_files, filter_out_paths_to_be_renamed, ExcludeMatcher, set_name_cache_size, DEFAULT_NAME_CACHE_SIZE  # noqa
+import batch_renamer.main as brm
+from test import ALLOWED, NON_ALLOWED, populate_directory_with_dirs, populate_directory_with_files  # noqa
+
+
+# pylama:ignore=D103
+PHASES = ('walk', 'filter', 'naming', 'dedup', 'validate', 'rename',
+          'revert')
+
+
+def generate_tree(root_dir, depth, fanout, files, dirty_ratio):
+    """Populate root_dir with a random tree.
+
+    Arguments:
+        root_dir (str): existing directory to populate.
+        depth (int): levels of subdirectories.
+        fanout (int): subdirectories of each directory.
+        files (int): files in each directory.
+        dirty_ratio (float): fraction of the names to be renamed.
+
+    Returns:
+        int: the number of entries created.
+
+    """
+    def populate(populate_function, one_dir, n_entries):
+        n_dirty = sum(random.random() < dirty_ratio
+                      for _ in range(n_entries))
+        for charset, n in ((ALLOWED, n_entries - n_dirty),
+                           (NON_ALLOWED, n_dirty)):
+            if n:
+                populate_function(charset, one_dir, n, n)
+
+    dirs_to_populate = [root_dir]
+    n_entries = 0
+    for level in range(depth + 1):
+        next_dirs_to_populate = []
+        for one_dir in dirs_to_populate:
+            populate(populate_directory_with_files, one_dir, files)
+            if level < depth:
+                populate(populate_directory_with_dirs, one_dir, fanout)
+            for one_entry in os.scandir(one_dir):
+                n_entries += 1
+                if one_entry.is_dir():
+                    next_dirs_to_populate.append(one_entry.path)
+        dirs_to_populate = next_dirs_to_populate
+    return n_entries
+
+
+class PhaseTimer(object):
+    """Time phases and count the entries each one processes."""
+
+    def __init__(self):
+        self.results = dict()
+
+    def __call__(self, phase, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        self.results[phase] = {'seconds': seconds}
+        return result
+
+    def count(self, phase, n_entries):
+        self.results[phase]['entries'] = n_entries
+        self.results[phase]['entries_per_second'] = (
+            n_entries / self.results[phase]['seconds']
+            if self.results[phase]['seconds'] else None)
+
+
+def run_benchmark(root_dir, historyfile, exclude_patterns):
+    timer = PhaseTimer()
+    exclude_matcher = ExcludeMatcher(exclude_patterns)
+    set_name_cache_size(DEFAULT_NAME_CACHE_SIZE)
+
+    batches = timer('walk', lambda: list(
+        directory_generation_starting_from_files(
+            [], [root_dir], exclude_matcher)))
+    timer.count('walk', sum(map(len, batches)))
+
+    batches = timer('filter', lambda: [
+        x for x in (
+            filter_out_paths_to_be_renamed(
+                one_batch, brm.RE_COMPILED_NOT_ALLOWED_EXPR,
+                exclude_matcher, False)
+            for one_batch in batches)
+        if x])
+    n_to_rename = sum(map(len, batches))
+    timer.count('filter', timer.results['walk']['entries'])
+
+    old_names = [[x.path for x in one_batch] for one_batch in batches]
+    new_names = timer('naming', lambda: [
+        brm.primitive_names(x) for x in old_names])
+    timer.count('naming', n_to_rename)
+
+    listings = dict()
+    plan = timer('dedup', lambda: [
+        brm.resolve_names(old, new, brm.get_existing_names(entries, listings))
+        for old, new, entries in zip(old_names, new_names, batches)])
+    timer.count('dedup', n_to_rename)
+
+    timer('validate', brm.validate_plan, plan)
+    timer.count('validate', n_to_rename)
+
+    with brm.Renamer(historyfile, exclude_matcher) as renamer:
+        entry_id = timer('rename', renamer.apply, plan)
+        timer.count('rename', sum(len(x[0]) for x in plan))
+
+        timer('revert', renamer.revert, entry_id)
+        timer.count('revert', timer.results['rename']['entries'])
+    return timer.results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Return the phases slower than in baseline by more than tolerance."""
+    regressions = []
+    for phase in PHASES:
+        old = baseline.get(phase, {}).get('entries_per_second')
+        new = results.get(phase, {}).get('entries_per_second')
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append(phase)
+    return regressions
+
+
+def print_report(results, baseline=None):
+    print('{0:<10} {1:>10} {2:>10} {3:>14} {4:>10}'.format(
+        'phase', 'entries', 'seconds', 'entries/s', 'baseline'))
+    for phase in PHASES:
+        result = results[phase]
+        relative = ''
+        if baseline and baseline.get(phase, {}).get('entries_per_second'):
+            relative = '{0:+.1%}'.format(
+                (result['entries_per_second'] or 0)
+                / baseline[phase]['entries_per_second'] - 1)
+        print('{0:<10} {1:>10} {2:>10.4f} {3:>14.0f} {4:>10}'.format(
+            phase, result['entries'], result['seconds'],
+            result['entries_per_second'] or 0, relative))
+    print('Maximum resident memory: {0:.1f} MiB'.format(
+        results['max_rss'] / 2**20))
+    if 'peak_memory' in results:
+        print('Peak traced memory: {0:.1f} MiB'.format(
+            results['peak_memory'] / 2**20))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Levels of subdirectories '
+                        '(default: %(default)s).')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='Subdirectories of each directory '
+                        '(default: %(default)s).')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Files in each directory '
+                        '(default: %(default)s).')
+    parser.add_argument('--dirty-ratio', type=float, default=0.5,
+                        help='Fraction of names to be renamed '
+                        '(default: %(default)s).')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random tree '
+                        '(default: %(default)s).')
+    parser.add_argument('--exclude', nargs='*', default=[],
+                        help='Exclude patterns.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Report the peak memory allocated by Python '
+                        '(slows down the phases).')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--baseline',
+                        help='Compare the results with this file, written '
+                        'by a previous run with --json.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Slowdown allowed relative to the baseline '
+                        '(default: %(default)s).')
+    return parser.parse_args()
+
+
+def main(args):
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as program_folder:
+        root_dir = os.path.join(program_folder, 'tree')
+        os.mkdir(root_dir)
+        historyfile = os.path.join(program_folder, 'historyfile.txt')
+        os.mknod(historyfile)
+        n_entries = generate_tree(root_dir, args.depth, args.fanout,
+                                  args.files, args.dirty_ratio)
+        print('Tree of {0} entries (depth {1}, fanout {2}, {3} files per '
+              'directory, dirty ratio {4}).'.format(
+                  n_entries, args.depth, args.fanout, args.files,
+                  args.dirty_ratio))
+        # Tracing the allocations slows down every phase.
+        if args.trace_memory:
+            tracemalloc.start()
+        results = run_benchmark(root_dir, historyfile, args.exclude)
+        if args.trace_memory:
+            results['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    # Kilobytes on Linux.
+    results['max_rss'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * 1024
+    results['parameters'] = vars(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'rt') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, 'wt') as json_file:
+            json.dump(results, json_file, indent=4)
+    if baseline:
+        regressions = compare_with_baseline(results, baseline,
+                                            args.tolerance)
+        if regressions:
+            print('Regressions: {0}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(parse_arguments()))
@@ -14,8 +14,18 @@ import datetime
 import math
 import hashlib
 import sys
-
-from batch_renamer.batch_renamer import primitive_name, generate_folder_structure, add_trailing_number, prefix_iso_mod_date  # noqa
+import re
+import argparse
+import time
+import json
+import errno
+import io
+import contextlib
+import subprocess
+import importlib.util
+from unittest import mock
+
+from batch_renamer.batch_renamer import primitive_name, generate_folder_structure, add_trailing_number, prefix_iso_mod_date, walk_entries, unidecode, set_name_cache_size, name_cache_info, DEFAULT_NAME_CACHE_SIZE, ExcludeMatcher, rename_no_replace, InotifyWatcher, PollingWatcher, prefix_iso_mod_dates, walk_entries_in_chunks, PathEntry  # noqa
 import batch_renamer.main as brm
 
 
@@ -30,6 +40,8 @@ NON_ALLOWED_SYMBOLS = (set(string.punctuation)
 NON_ALLOWED_CHARS = set(string.ascii_uppercase)
 NON_ALLOWED = NON_ALLOWED_SYMBOLS | NON_ALLOWED_CHARS
 
+UNIDECODE_INSTALLED = importlib.util.find_spec('unidecode') is not None
+
 # Number of tests to run.
 N = 1  # Number of strings in each folder.
 
@@ -131,6 +143,27 @@ def recursive_populate_directory_with_files(
             **kwargs_populate_directory_with_files)
 
 
+def reference_primitive_name(x):
+    """Compute primitive_name with the original sequence of substitutions."""
+    basename = unidecode(os.path.basename(x)).lower()
+    basename = re.sub(
+        r'''(?<=_)[^0-9a-zA-Z\_\.]+
+            |
+            [^0-9a-zA-Z\_\.]+(?=_)''',
+        '',
+        basename,
+        flags=(re.VERBOSE))
+    basename = re.sub(r'^[^0-9a-zA-Z\_\.]+', '', basename)
+    basename = re.sub(r'[^0-9a-zA-Z\_\.]+', '_', basename)
+    basename = re.sub(r'_+(?=\.[^.]+$)', '', basename)
+    basename = re.sub('_+$', '', basename)
+    basename = re.search('^_*', basename).group() \
+        + re.sub('_+', '_', re.sub('(_*)([^_].+)', '\\2', basename))
+    if basename == '':
+        basename = '_'
+    return os.path.join(os.path.dirname(x), basename)
+
+
 class MetaCreateSerializedTests(type):
     """Metaclas to create N number of tests.
 
@@ -227,7 +260,9 @@ class TestBatchRenamer(unittest.TestCase, metaclass=MetaCreateSerializedTests):
             arg_excludepatternfile=None,
             arg_verbose=None,
             arg_prefixisomoddate=None,
-            arg_dryrun=None,):
+            arg_dryrun=None,
+            arg_plan_out=None,
+            arg_apply_plan=None,):
         # Intercept created arguments.
         new_sys_argv = []
         # Input.
@@ -255,6 +290,14 @@ class TestBatchRenamer(unittest.TestCase, metaclass=MetaCreateSerializedTests):
         # Dry run.
         if arg_dryrun is not None:
             new_sys_argv.append('--dryrun')
+        # Plan file to write.
+        if arg_plan_out is not None:
+            new_sys_argv.append('--plan-out')
+            new_sys_argv.append(arg_plan_out)
+        # Plan file to execute.
+        if arg_apply_plan is not None:
+            new_sys_argv.append('--apply-plan')
+            new_sys_argv.append(arg_apply_plan)
         # Modify the system argv.
         sys.argv = [sys.argv[0], ] + new_sys_argv
         parser = brm.create_batch_renamer_parser()
@@ -299,6 +342,127 @@ class TestBatchRenamerNormal(TestBatchRenamer):
             self.non_compliant_folder)
         self.assertNotEqual(before_hash, after_hash)
 
+    def test_plan_file(self):
+
+        self.setup_config_folder()
+        self.setup_non_compliant_folder()
+
+        before_hash = self.get_path_representation_hash(
+            self.non_compliant_folder)
+        planfile = os.path.join(self.config_folder, 'plan.jsonl')
+        for arguments in ({'arg_dryrun': True}, {'arg_plan_out': planfile}):
+            brm.main(self.emulate_cli_arguments(
+                arg_input=self.non_compliant_folder,
+                arg_historyfile=self.historyfile,
+                arg_excludepatternfile=self.excludepatternfile,
+                **arguments))
+            self.assertEqual(
+                before_hash,
+                self.get_path_representation_hash(self.non_compliant_folder))
+        renamings = list(brm.read_plan_file(planfile))
+        self.assertTrue(renamings)
+        self.assertEqual(os.path.getsize(self.historyfile), 0)
+
+        brm.main(self.emulate_cli_arguments(
+            arg_apply_plan=planfile,
+            arg_historyfile=self.historyfile))
+        self.assertFalse(any(map(os.path.lexists, (x[0] for x in renamings))))
+        # Applying it again would overwrite the files renamed.
+        with self.assertRaises(ValueError):
+            brm.main(self.emulate_cli_arguments(
+                arg_apply_plan=planfile,
+                arg_historyfile=self.historyfile))
+        with self.assertRaises(ValueError):
+            self.emulate_cli_arguments(
+                arg_input=self.non_compliant_folder,
+                arg_apply_plan=planfile,
+                arg_historyfile=self.historyfile,
+                arg_excludepatternfile=self.excludepatternfile)
+
+    def test_stats_file(self):
+
+        self.setup_config_folder()
+        self.setup_non_compliant_folder()
+
+        args = self.emulate_cli_arguments(
+            arg_input=self.non_compliant_folder,
+            arg_historyfile=self.historyfile,
+            arg_excludepatternfile=self.excludepatternfile)
+        args.stats = os.path.join(self.config_folder, 'stats.json')
+        brm.main(args)
+        with open(args.stats) as stats_file:
+            stats = json.load(stats_file)
+        counters = stats['counters']
+        self.assertGreater(counters['renamed'], 0)
+        self.assertEqual(counters['renamed'],
+                         counters['entries_to_rename'] - counters['unchanged'])
+        self.assertEqual(stats['histograms']['rename']['count'],
+                         counters['renamed'])
+        self.assertEqual(
+            sum(stats['histograms']['rename']['buckets_us'].values()),
+            counters['renamed'])
+        for phase in ('walk', 'filter', 'naming', 'dedup', 'validate',
+                      'rename', 'history'):
+            self.assertIn(phase, stats['phase_seconds'])
+
+    def test_renamer(self):
+
+        self.setup_config_folder()
+        self.setup_non_compliant_folder()
+
+        before_hash = self.get_path_representation_hash(
+            self.non_compliant_folder)
+        with brm.Renamer(self.historyfile, ['$^']) as renamer:
+            plan = renamer.plan([self.non_compliant_folder])
+            entry_id = renamer.apply(plan)
+            self.assertNotEqual(
+                before_hash,
+                self.get_path_representation_hash(self.non_compliant_folder))
+            # The same renamer is used again.
+            self.assertEqual(renamer.plan([self.non_compliant_folder]), [])
+            renamer.revert(entry_id)
+            self.assertEqual(
+                before_hash,
+                self.get_path_representation_hash(self.non_compliant_folder))
+            self.assertEqual(renamer.plan([self.non_compliant_folder]), plan)
+        # Other renamers with the same cache size keep the cache.
+        cache_info = name_cache_info()
+        self.assertGreater(cache_info.currsize, 0)
+        brm.Renamer(self.historyfile, ['$^']).close()
+        self.assertEqual(name_cache_info(), cache_info)
+
+    def test_rename_in_chunks(self):
+
+        self.setup_config_folder()
+        self.setup_non_compliant_folder()
+
+        chunks = list(walk_entries_in_chunks(self.non_compliant_folder, 2))
+        self.assertTrue(all(len(x) <= 2 for x in chunks))
+        self.assertEqual(
+            sorted(x.path for one_chunk in chunks for x in one_chunk),
+            sorted([self.non_compliant_folder]
+                   + [x.path for _, children
+                      in walk_entries(self.non_compliant_folder)
+                      for x in children]))
+
+        before_hash = self.get_path_representation_hash(
+            self.non_compliant_folder)
+        n_entries = sum(len(x) for x in chunks)
+        with brm.Renamer(self.historyfile, ['$^'],
+                         chunk_size=2) as renamer:
+            entry_id = renamer.rename([self.non_compliant_folder])
+            entries = [x for _, children
+                       in walk_entries(self.non_compliant_folder)
+                       for x in children]
+            self.assertEqual(len(entries) + 1, n_entries)
+            self.assertFalse(any(
+                brm.RE_COMPILED_NOT_ALLOWED_EXPR.search(x.name)
+                for x in entries))
+            renamer.revert(entry_id)
+        self.assertEqual(
+            before_hash,
+            self.get_path_representation_hash(self.non_compliant_folder))
+
     def test_bogus_cli_calls(self):
         """Test wrong CLI calls."""
         # TODO: implement.
@@ -335,6 +499,148 @@ class TestBatchRenamerNormal(TestBatchRenamer):
                 self.assertEqual(s.replace('__', '_'),
                                  primitive_name(s))
 
+    def test_primitive_name_equivalence(self):
+        # Small charsets make the corner cases (underscores next to symbols
+        # and dots) frequent.
+        charsets = (ALLOWED_SYMBOLS | set('a%'),
+                    ALLOWED | NON_ALLOWED | set(' \n'),
+                    ALLOWED_SYMBOLS | set('aZ%\xe9'))
+        for charset in charsets:
+            for _ in range(10000):
+                s = create_random_string(charset, min_len=0, max_len=12)
+                self.assertEqual(reference_primitive_name(s),
+                                 primitive_name(s),
+                                 msg=repr(s))
+
+    def test_name_cache(self):
+        set_name_cache_size(2)
+        self.addCleanup(set_name_cache_size, DEFAULT_NAME_CACHE_SIZE)
+        for dirname in ('/a', '/b', '/c'):
+            self.assertEqual(primitive_name(os.path.join(dirname, 'A b')),
+                             os.path.join(dirname, 'a_b'))
+            primitive_name(os.path.join(dirname, 'Thumbs.db'))
+        cache_info = name_cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (4, 2))
+        primitive_name('/d/C')
+        self.assertEqual(name_cache_info().currsize, 2)
+
+    def test_unidecode(self):
+        ascii_text = 'Plain ASCII.txt'
+        self.assertIs(unidecode(ascii_text), ascii_text)
+        # The unidecode package is only imported for non ASCII text.
+        script = '\n'.join((
+            'import sys',
+            'import batch_renamer.batch_renamer as module',
+            'module.primitive_name("/a/Plain ASCII.txt")',
+            'assert "unidecode" not in sys.modules',
+            'module.primitive_name("/a/Caf\\xe9")',
+            'assert ("unidecode" in sys.modules) == {0!r}'.format(
+                UNIDECODE_INSTALLED)))
+        subprocess.run([sys.executable, '-c', script], check=True,
+                       env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+                           x or os.curdir for x in sys.path)))
+
+    @unittest.skipUnless(UNIDECODE_INSTALLED, 'unidecode is not installed')
+    def test_unidecode_package(self):
+        import unidecode as unidecode_package
+        # The last text is transliterated from the characters already seen.
+        for text in ('Ñandú café', 'æ中文 x', 'Ελληνικά.txt', '\U0001F600 b',
+                     'Ñandú café'):
+            self.assertEqual(unidecode(text),
+                             unidecode_package.unidecode(text))
+
+    def test_exclude_matcher(self):
+        patterns = (r'.*\.git.*', r'.*\/\..*', r'(a)\1', '(?i)X', 'b$', '$^',
+                    '^/g', r'^\.x$', r'.*\/\\..*')
+        exclude_matcher = ExcludeMatcher(patterns)
+        for _ in range(1000):
+            s = create_random_string('/.gitaxXb\\', min_len=0, max_len=15)
+            with self.subTest(s=s):
+                self.assertEqual(
+                    exclude_matcher.excludes(s),
+                    any(re.search(x, s) for x in patterns))
+        self.assertEqual(exclude_matcher.matching_pattern('/x/.y').pattern,
+                         patterns[1])
+        self.assertIsNone(exclude_matcher.matching_pattern('/y'))
+        self.assertTrue(exclude_matcher.excludes_subtree('/x/.git'))
+        # 'b$' excludes '/a/b' but not what is inside it.
+        self.assertTrue(exclude_matcher.excludes('/a/b'))
+        self.assertFalse(exclude_matcher.excludes_subtree('/a/b'))
+
+    def test_plan_names_in_parallel(self):
+        batches = [
+            [os.path.join('/d{0}'.format(i), create_random_string(NON_ALLOWED))
+             for _ in range(random.randint(1, 5))]
+            for i in range(20)]
+        batches.append(['/e/A', '/e/A%'])
+
+        # The sets of existing names are updated by the planning so each
+        # plan gets its own.
+        def with_existing_names():
+            return [(x, {os.path.dirname(x[0]): {'a', 'a_0'}})
+                    for x in batches]
+
+        brm.run_stats.reset()
+        self.assertEqual(
+            list(brm.plan_names_in_parallel(with_existing_names(), 2,
+                                            DEFAULT_NAME_CACHE_SIZE)),
+            [brm.plan_names(*x) for x in with_existing_names()])
+        # The name cache of the pool processes is accounted for.
+        counters = brm.run_stats.counters
+        self.assertEqual(counters['name_cache_pool_hits']
+                         + counters['name_cache_pool_misses'],
+                         sum(len(x) for x in batches))
+
+        # The batches are read as the pool needs them.
+        n_read = []
+
+        def many_batches():
+            for i in range(100000):
+                n_read.append(i)
+                yield (['/d/A{0}'.format(i)], None)
+
+        plans = brm.plan_names_in_parallel(many_batches(), 2,
+                                           DEFAULT_NAME_CACHE_SIZE)
+        self.assertEqual(next(plans), (['/d/A0'], ['/d/a0']))
+        plans.close()
+        self.assertLessEqual(len(n_read), 5 * brm.PLAN_CHUNK_SIZE)
+
+    def test_rename_no_replace(self):
+
+        self.setup_working_folder()
+        for name in ('a', 'b'):
+            os.mknod(os.path.join(self.working_folder, name))
+
+        with self.assertRaises(FileExistsError):
+            rename_no_replace(os.path.join(self.working_folder, 'a'),
+                              os.path.join(self.working_folder, 'b'))
+        dir_fd = os.open(self.working_folder, os.O_RDONLY)
+        self.addCleanup(os.close, dir_fd)
+        with self.assertRaises(FileExistsError):
+            rename_no_replace('b', 'a', dir_fd=dir_fd)
+        rename_no_replace('a', 'c', dir_fd=dir_fd)
+        self.assertEqual(sorted(os.listdir(self.working_folder)), ['b', 'c'])
+
+        # A filesystem without RENAME_NOREPLACE does not disable renameat2
+        # for the others.
+        module = sys.modules[rename_no_replace.__module__]
+        renameat2 = (mock.Mock(return_value=-1), lambda: errno.EINVAL)
+        with mock.patch.object(module, '_renameat2', renameat2):
+            rename_no_replace('c', 'd', dir_fd=dir_fd)
+            self.assertIs(module._renameat2, renameat2)
+        self.assertEqual(sorted(os.listdir(self.working_folder)), ['b', 'd'])
+
+        # Renamings in directories that cannot be opened are done by path.
+        dir_fds = dict()
+        with mock.patch('os.open', side_effect=PermissionError):
+            for name, new_name in (('b', 'e'), ('d', 'f')):
+                brm._rename(os.path.join(self.working_folder, name),
+                            os.path.join(self.working_folder, new_name),
+                            dir_fds)
+        self.assertEqual(dir_fds, {self.working_folder: None})
+        brm._close_dir_fds(dir_fds)
+        self.assertEqual(sorted(os.listdir(self.working_folder)), ['e', 'f'])
+
     def test_add_trailing_number(self):
         # 10k max size takes some time.
         iterable_sizes = (10 ** x for x in range(1, 6))
@@ -344,6 +650,117 @@ class TestBatchRenamerNormal(TestBatchRenamer):
                     n=size):
                 self.assertEqual(len(s), round(math.log(size, 10) + 2))
 
+    def test_deduplicate_names(self):
+        self.assertEqual(
+            brm.deduplicate_names(['a', 'b', 'a', 'c', 'b', 'a_1', 'a']),
+            ['a_0', 'b_0', 'a_2', 'c', 'b_1', 'a_1', 'a_3'])
+        names = ['x'] * 12 + ['y']
+        deduplicated_names = brm.deduplicate_names(names)
+        self.assertEqual(deduplicated_names[:2], ['x_00', 'x_01'])
+        self.assertEqual(deduplicated_names[-2:], ['x_11', 'y'])
+        self.assertEqual(len(set(deduplicated_names)), len(names))
+        # Names taken on disk are avoided as well.
+        self.assertEqual(
+            brm.deduplicate_names(['/d/a', '/d/b', '/d/b'],
+                                  exists={'/d/a', '/d/b_0'}.__contains__),
+            ['/d/a_0', '/d/b_1', '/d/b_2'])
+        self.assertEqual(
+            brm.plan_names(['/d/A', '/d/a', '/d/B'], {'/d': {'A', 'a', 'B'}}),
+            (['/d/A', '/d/B'], ['/d/a_0', '/d/b']))
+
+    def test_validate_plan(self):
+        # Chains in the right order are valid.
+        brm.validate_plan([(['/d/b', '/d/a'], ['/d/c', '/d/b'])])
+        brm.validate_plan([(['/d/a'], ['/d/x'])],
+                          exists={'/d/a'}.__contains__)
+        invalid_plans = (
+            [(['/d/a', '/d/b'], ['/d/c', '/d/c'])],
+            [(['/d/a'], ['/d/b']), (['/d/b'], ['/d/c'])],
+            [(['/d/a', '/d/b'], ['/d/b', '/d/a'])],
+            [(['/d/a'], ['/d/b']), (['/d/a'], ['/d/c'])],
+        )
+        for plan in invalid_plans:
+            with self.assertRaises(ValueError):
+                brm.validate_plan(plan)
+        with self.assertRaises(ValueError):
+            brm.validate_plan([(['/d/a'], ['/d/b'])],
+                              exists={'/d/b'}.__contains__)
+
+    def test_compact_plan(self):
+        plan = [(['/d/a', '/d/e/B', 'c', '/d/e'],
+                 ['/d/b', '/d/e/b', 'c_1', '/d/f']),
+                ([], []),
+                (['/x/'], ['/y/'])]
+        compact_plan = brm.CompactPlan(plan)
+        self.assertEqual(len(compact_plan), 2)
+        self.assertEqual(list(compact_plan), [plan[0], plan[2]])
+        self.assertEqual(compact_plan[-1], plan[2])
+        self.assertEqual(compact_plan, [plan[0], plan[2]])
+        # Each directory is stored once.
+        self.assertEqual(sorted(compact_plan.directories),
+                         ['', '/d', '/d/e', '/x', '/y'])
+
+        brm.validate_plan(compact_plan)
+        for plan in ([(['/d/a', '/d/b'], ['/d/c', '/d/c'])],
+                     [(['/d/a'], ['/d/b']), (['/d/b'], ['/d/c'])]):
+            with self.assertRaises(ValueError):
+                brm.validate_plan(brm.CompactPlan(plan))
+        with self.assertRaises(ValueError):
+            brm.validate_plan(brm.CompactPlan([(['/d/a'], ['/d/b'])]),
+                              exists={'/d/b'}.__contains__)
+
+    def test_state_file(self):
+        self.setup_config_folder()
+        self.setup_compliant_folder()
+        subfolder = os.path.join(self.compliant_folder, 'sub')
+        os.mkdir(subfolder)
+        # Directories modified right before a run are not recorded.
+        past = time.time() - 3600
+        for folder in (self.compliant_folder, subfolder):
+            os.utime(folder, (past, past))
+        args = self.emulate_cli_arguments(
+            arg_input=self.compliant_folder,
+            arg_historyfile=self.historyfile,
+            arg_excludepatternfile=self.excludepatternfile)
+        args.state_file = os.path.join(self.config_folder, 'state.json')
+        brm.main(args)
+        with open(args.state_file) as state:
+            self.assertEqual(set(json.load(state)['directories']),
+                             {self.compliant_folder, subfolder})
+
+        # A new name hidden from the modification time is not seen.
+        hidden_file = os.path.join(subfolder, 'Hidden')
+        os.mknod(hidden_file)
+        os.utime(subfolder, (past, past))
+        brm.main(args)
+        self.assertTrue(os.path.exists(hidden_file))
+
+        # Modified directories are walked again.
+        os.utime(subfolder)
+        brm.main(args)
+        self.assertFalse(os.path.exists(hidden_file))
+        self.assertTrue(os.path.exists(os.path.join(subfolder, 'hidden')))
+
+        # The subtrees of a changed directory are checked once.
+        chain = [self.compliant_folder]
+        for i in range(10):
+            chain.append(os.path.join(chain[-1], 'd{0}'.format(i)))
+            os.mkdir(chain[-1])
+        records = dict()
+        for folder in chain:
+            os.utime(folder, (past, past))
+            stat_result = os.stat(folder)
+            records[folder] = [stat_result.st_dev, stat_result.st_ino,
+                               stat_result.st_mtime_ns]
+        with open(args.state_file, 'wt') as state:
+            json.dump({'fingerprint': 'f', 'directories': records}, state)
+        os.utime(chain[-1])
+        state_index = brm.StateIndex(args.state_file, 'f')
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            self.assertFalse(any(state_index.skip_subtree(PathEntry(x))
+                                 for x in chain))
+        self.assertEqual(stat.call_count, len(chain))
+
     def test_prefix_iso_mod_date(self):
 
         self.setup_compliant_folder()
@@ -356,6 +773,286 @@ class TestBatchRenamerNormal(TestBatchRenamer):
                     os.path.basename(prefix_iso_mod_date(file_path))
                     .startswith(self.now.strftime('%Y%m%d_')))
 
+        # Given modification times, cached per day.
+        for _ in range(1000):
+            mtime = random.uniform(0, 2 * 10**9)
+            with self.subTest(mtime=mtime):
+                self.assertEqual(
+                    prefix_iso_mod_date('/d/20000101_a.txt', mtime),
+                    datetime.datetime.fromtimestamp(mtime).strftime(
+                        '/d/%Y%m%d_a.txt'))
+
+        entries = [x[0] for x in walk_entries(self.working_folder)]
+        entries += [x for x in walk_entries(self.compliant_folder)][0][1]
+        self.assertEqual(
+            prefix_iso_mod_dates(entries),
+            [x.path if x.is_dir() else prefix_iso_mod_date(x.path)
+             for x in entries])
+
+    def test_walk_entries(self):
+
+        self.setup_working_folder()
+        recursive_populate_directory_with_dirs(
+            NON_ALLOWED,
+            self.working_folder,
+            depth=3)
+        recursive_populate_directory_with_files(
+            NON_ALLOWED,
+            self.working_folder)
+
+        walked = [
+            (directory.path,
+             sorted(x.name for x in children if x.is_dir()),
+             sorted(x.name for x in children if x.is_file()))
+            for directory, children in walk_entries(self.working_folder)]
+        expected = [(x[0], sorted(x[1]), sorted(x[2]))
+                    for x in os.walk(self.working_folder, topdown=False)]
+        self.assertEqual(sorted(walked), sorted(expected))
+        # Bottom-up: every directory comes after all of its subdirectories.
+        position = {x[0]: i for i, x in enumerate(walked)}
+        self.assertTrue(all(
+            position[x[0]] < position[os.path.dirname(x[0])]
+            for x in walked[:-1]))
+        # Listing directories in threads does not change the order.
+        self.assertEqual(
+            [x[0].path for x in walk_entries(self.working_folder)],
+            [x[0].path for x in walk_entries(self.working_folder, workers=4)])
+
+        # The threads only list the next directories to be walked.
+        wide_folder = os.path.join(self.working_folder, 'wide')
+        for i in range(300):
+            os.makedirs(os.path.join(wide_folder, str(i)))
+        module = sys.modules[walk_entries.__module__]
+        scanned = []
+        scan_directory = module._scan_directory
+
+        def counting_scan_directory(path):
+            scanned.append(path)
+            return scan_directory(path)
+
+        with mock.patch.object(module, '_scan_directory',
+                               counting_scan_directory):
+            walk = walk_entries(wide_folder, workers=4)
+            next(walk)
+            walk.close()
+        self.assertLessEqual(len(scanned),
+                             2 + 4 * module.WALK_SCAN_AHEAD)
+
+    def test_watchers(self):
+        self.setup_working_folder()
+        os.mkdir(os.path.join(self.working_folder, 'old'))
+        watchers = [PollingWatcher([self.working_folder], interval=0.01)]
+        try:
+            watchers.append(InotifyWatcher([self.working_folder]))
+        except OSError:
+            pass
+        new_file = os.path.join(self.working_folder, 'old', 'New File')
+        new_folder = os.path.join(self.working_folder, 'New Folder')
+        open(new_file, 'w').close()
+        os.mkdir(new_folder)
+        os.mknod(os.path.join(new_folder, 'Inside'))
+        module = sys.modules[InotifyWatcher.__module__]
+        for watcher in watchers:
+            with watcher, mock.patch.object(module, 'NEW_PATH_SETTLE_DELAY',
+                                            0.1):
+                new_paths = set()
+                while True:
+                    more_paths = watcher.wait(0.2)
+                    if not more_paths:
+                        break
+                    new_paths.update(more_paths)
+                self.assertEqual(brm.split_new_paths(new_paths),
+                                 ([new_file], [new_folder]))
+                # Renamed directories are still watched.
+                renamed_folder = new_folder + '_renamed'
+                os.rename(new_folder, renamed_folder)
+                self.assertIn(renamed_folder, watcher.wait(1))
+                later_file = os.path.join(renamed_folder, 'Later')
+                with open(later_file, 'w') as f:
+                    f.write('x')
+                    f.flush()
+                    if isinstance(watcher, InotifyWatcher):
+                        # Files are reported once written.
+                        self.assertEqual(watcher.wait(0.2), [])
+                self.assertEqual(watcher.wait(1), [later_file])
+                os.rename(renamed_folder, new_folder)
+                os.remove(os.path.join(new_folder, 'Later'))
+                watcher.wait(0.2)
+
+        # Directories that cannot be watched with inotify are polled.
+        with mock.patch.object(InotifyWatcher, '_watch_tree',
+                               side_effect=OSError('No space left')):
+            with brm.open_watcher([self.working_folder]) as watcher:
+                self.assertIsInstance(watcher, PollingWatcher)
+
+    def test_inotify_files_being_written(self):
+        self.setup_working_folder()
+        try:
+            watcher = InotifyWatcher([self.working_folder])
+        except OSError:
+            self.skipTest('inotify is not available')
+        module = sys.modules[InotifyWatcher.__module__]
+        incoming = os.path.join(self.working_folder, 'Incoming Dir')
+        with watcher, mock.patch.object(module, 'NEW_PATH_SETTLE_DELAY',
+                                        0.1):
+            # New directories are not reported while their files are
+            # written, whether they were opened before the directory was
+            # watched or after.
+            os.mkdir(incoming)
+            with open(os.path.join(incoming, 'Part One'), 'w'):
+                self.assertEqual(watcher.wait(0.3), [])
+                with open(os.path.join(incoming, 'Part Two'), 'w'):
+                    self.assertEqual(watcher.wait(0.3), [])
+            self.assertEqual(watcher.wait(1), [incoming])
+            # Files that are never opened are reported after the delay.
+            node = os.path.join(self.working_folder, 'Node')
+            os.mknod(node)
+            self.assertEqual(watcher.wait(1), [node])
+            # Files moved while written are reported under their new name.
+            moving = os.path.join(self.working_folder, 'Moving')
+            moved = os.path.join(self.working_folder, 'Moved')
+            with open(moving, 'w'):
+                os.rename(moving, moved)
+                self.assertEqual(watcher.wait(0.3), [])
+            self.assertEqual(watcher.wait(1), [moved])
+            # Files removed while written are forgotten.
+            removed = os.path.join(self.working_folder, 'Removed')
+            with open(removed, 'w'):
+                self.assertEqual(watcher.wait(0.3), [])
+                os.remove(removed)
+                self.assertEqual(watcher.wait(0.3), [])
+            self.assertEqual(watcher.wait(0.3), [])
+            self.assertEqual(watcher._files_being_written, set())
+
+
+class TestBatchRenamerHistory(TestBatchRenamer):
+
+    def test_history_index(self):
+
+        self.setup_config_folder()
+
+        ids = []
+        for n_lines in (3, 0, 5):
+            brm.write_header_to_historyfile(self.historyfile)
+            ids.append(brm.get_last_id_from_change_in_historyfile(
+                self.historyfile) - 1)
+            brm.append_to_historyfile(self.historyfile,
+                                      'mv "a" "b"\n' * n_lines)
+        with open(self.historyfile, 'rt') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(
+            ids,
+            [i for i, x in enumerate(lines) if x.startswith(brm.HEADER_START)])
+
+        with brm.HistoryIndex(self.historyfile) as index:
+            records = [index.entry(i) for i in range(len(index))]
+            self.assertEqual(index.find(ids[1]), 1)
+        # A missing index is rebuilt from the history file.
+        os.remove(self.historyfile + brm.HISTORY_INDEX_SUFFIX)
+        with brm.HistoryIndex(self.historyfile) as index:
+            self.assertEqual([index.entry(i) for i in range(len(index))],
+                             records)
+            self.assertEqual(index.n_lines, len(lines))
+
+        args = self.emulate_cli_arguments(
+            arg_revert=str(ids[0]),
+            arg_historyfile=self.historyfile)
+        change_range = brm.get_range_from_history_file(args)
+        self.assertEqual(
+            list(brm.read_lines_from_historyfile(self.historyfile,
+                                                 *change_range)),
+            lines[ids[0]:ids[1]])
+        self.assertEqual(
+            list(brm.read_lines_from_historyfile(self.historyfile,
+                                                 *change_range,
+                                                 reverse=True)),
+            lines[ids[0]:ids[1]][::-1])
+        self.assertEqual(
+            brm.get_rename_changes_from_historyfile(self.historyfile,
+                                                    change_range),
+            [('a', 'b')] * 3)
+
+    def test_history_writer(self):
+
+        self.setup_config_folder()
+
+        with brm.HistoryWriter(self.historyfile, sync=2) as history_writer:
+            change_number = history_writer.write_header()
+            history_writer.write_batch(['mv "b" "a"'])
+            # Only the header reached the file: the renaming is buffered.
+            with open(self.historyfile, 'rt') as f:
+                self.assertEqual(len(f.read().splitlines()), 1)
+            history_writer.write_batch(['mv "d" "c"'])
+            # The second renaming triggers the sync.
+            with open(self.historyfile, 'rt') as f:
+                self.assertEqual(f.read().splitlines()[1:],
+                                 ['mv "b" "a"', 'mv "d" "c"'])
+        with brm.HistoryIndex(self.historyfile) as index:
+            self.assertEqual(index.entry(-1)[0], change_number)
+            self.assertEqual(index.n_lines, 3)
+
+        self.assertEqual(brm.history_sync_policy('batch'), 'batch')
+        self.assertEqual(brm.history_sync_policy('100'), 100)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            brm.history_sync_policy('0')
+
+    def test_history_written_per_renaming(self):
+
+        self.setup_config_folder()
+
+        renamed = []
+
+        def rename(src, dst, dir_fds):
+            if len(renamed) == 3:
+                raise KeyboardInterrupt
+            renamed.append(src)
+
+        old_names = ['/d/{0}'.format(i) for i in range(6)]
+        new_names = ['/d/n{0}'.format(i) for i in range(6)]
+        writer = brm.HistoryWriter(self.historyfile, sync=1)
+        writer.write_header()
+        # The history file is read before the writer is closed, as if the
+        # process had crashed.
+        with mock.patch.object(brm, '_rename', rename):
+            with self.assertRaises(KeyboardInterrupt):
+                brm.execute_renaming(old_names, new_names, writer)
+        with open(self.historyfile, 'rt') as f:
+            self.assertEqual(
+                f.read().splitlines()[1:],
+                ['mv "/d/n{0}" "/d/{0}"'.format(i) for i in range(3)])
+        writer.close()
+
+    def test_history_file_creation(self):
+
+        self.setup_config_folder()
+        self.setup_non_compliant_folder()
+
+        new_historyfile = os.path.join(self.config_folder, 'new.txt')
+        with self.assertRaises(FileNotFoundError):
+            brm.HistoryIndex(new_historyfile)
+        self.assertFalse(os.path.exists(
+            new_historyfile + brm.HISTORY_INDEX_SUFFIX))
+        # The history file is created when first written.
+        with brm.Renamer(new_historyfile, ['$^']) as renamer:
+            self.assertFalse(os.path.exists(new_historyfile))
+            renamer.apply([])
+        self.assertTrue(os.path.isfile(new_historyfile))
+
+        # Planning reads the index without writing it.
+        index_file = new_historyfile + brm.HISTORY_INDEX_SUFFIX
+        os.remove(index_file)
+        with brm.Renamer(new_historyfile, ['$^']) as renamer:
+            renamer.plan([self.non_compliant_folder])
+            self.assertEqual(renamer.revert_plan(), [])
+        for dryrun_args in ({'arg_input': self.non_compliant_folder},
+                            {'arg_revert': 'last'}):
+            with contextlib.redirect_stdout(io.StringIO()):
+                brm.main(self.emulate_cli_arguments(
+                    arg_historyfile=new_historyfile,
+                    arg_excludepatternfile=self.excludepatternfile,
+                    arg_dryrun=True, **dryrun_args))
+        self.assertFalse(os.path.exists(index_file))
+
 
 class TestBatchRenamerRevert(TestBatchRenamer):
 
@@ -405,6 +1102,33 @@ class TestBatchRenamerRevert(TestBatchRenamer):
         # Execute the first assertion.
         self.assertEqual(first_hash, third_hash)
 
+    def test_revert_entry_with_reverted_renamings(self):
+
+        self.setup_non_compliant_folder()
+        self.setup_config_folder()
+
+        with brm.Renamer(self.historyfile, ['$^']) as renamer:
+            first_id = renamer.rename([self.non_compliant_folder])
+            deepest_folder = max(
+                (x[0] for x in os.walk(self.non_compliant_folder)),
+                key=lambda x: x.count(os.sep))
+            os.mknod(os.path.join(deepest_folder, 'New File'))
+            renamer.rename([self.non_compliant_folder])
+            second_hash = self.get_path_representation_hash(
+                self.non_compliant_folder)
+            # Each revert is an entry of its own, which can be reverted.
+            revert_id = renamer.revert(first_id)
+            self.assertNotEqual(
+                second_hash,
+                self.get_path_representation_hash(self.non_compliant_folder))
+            self.assertEqual(renamer.revert(),
+                             renamer.history_writer.index.entry(-1)[0])
+            self.assertGreater(renamer.history_writer.index.entry(-1)[0],
+                               revert_id)
+        self.assertEqual(
+            second_hash,
+            self.get_path_representation_hash(self.non_compliant_folder))
+
 
 
 if __name__ == "__main__":